@@ -0,0 +1,51 @@
+import argparse
+import json
+import logging
+import sys
+from config import Configuration
+from sim.benchmark import Benchmark, compare
+
+logger = logging.getLogger("benchmark")
+
+
+def main(config_file: str, sizes: list, approaches: list, repeat: int, scaling: int, output: str, baseline: str, threshold: float):
+    config = Configuration(config_file)
+
+    benchmark = Benchmark(config, sizes=sizes, approaches=approaches, repeat=repeat, scaling=scaling)
+    logger.debug("Starting benchmark")
+    results = benchmark.run()
+    benchmark.save(results, output)
+
+    for r in results:
+        approach = r['approach'] or '-'
+        print(f"{r['case']:<60} {r['size']:>6} {approach:<11} {r['median'] * 1e3:>12.3f} ms")
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f)['results'], threshold)
+        for result, old, ratio in regressions:
+            print(f"REGRESSION {result['case']} size={result['size']} approach={result['approach']}: "
+                  f"{old['median'] * 1e3:.3f} ms -> {result['median'] * 1e3:.3f} ms ({ratio:.2f}x)")
+        if regressions:
+            print(f"{len(regressions)} regressions compared to {baseline}", file=sys.stderr)
+            exit(1)
+        print(f"No regressions compared to {baseline}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", help="Path to the configuration file (default: sim.ini)", type=str, default="sim.ini")
+    parser.add_argument("-d", "--debug", help="Debug mode with the given log level", type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='INFO')
+    parser.add_argument("-s", "--sizes", help=f"Grid sizes to benchmark (default: {' '.join(map(str, Benchmark.SIZES))})", type=int, nargs="+", default=list(Benchmark.SIZES))
+    parser.add_argument("-a", "--approaches", help="Rule approaches to benchmark (default: all)", type=str, nargs="+", choices=Benchmark.APPROACHES, default=list(Benchmark.APPROACHES))
+    parser.add_argument("-r", "--repeat", help="Timed runs of every case (default: 5)", type=int, default=5)
+    parser.add_argument("--scaling", help="Scaling of the images written by visualizers and backends (default: 1)", type=int, default=1)
+    parser.add_argument("-o", "--output", help="Path of the JSON results (default: benchmark.json)", type=str, default="benchmark.json")
+    parser.add_argument("-b", "--baseline", help="JSON results of an earlier run to compare against", type=str)
+    parser.add_argument("-t", "--threshold", help="Relative slowdown of the median reported as regression (default: 0.1)", type=float, default=0.1)
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.debug.upper(), logging.INFO)
+    logging.basicConfig(filename="benchmark.log", level=log_level)
+
+    main(args.config, args.sizes, args.approaches, args.repeat, args.scaling, args.output, args.baseline, args.threshold)
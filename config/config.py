@@ -6,14 +6,23 @@ class Configuration:
         'preset': {
             'source': 'random',
             'file': None,
+            'validate': True,
         },
         'simulation': {
             'size': 10,
             'steps': 5,
             'seed': 123,
             'neighborhood' : 'NeumannNeighborhood',
+            'radius': 1,
+            'boundary': 'zero',
+            'layout': 'plain',
             'rules': 'DecreaseWhenFireRule',
             'rule_approach': 'general',
+            'engine': 'sequential',
+            'dtype': 'default',
+            'tile_size': 0,
+            'tile_threshold': 0.25,
+            'workers': 0,
             # thresholds and probabilities for CellOnFireRule
             'threshold_sum': 8,
             't_heat': 3,
@@ -25,16 +34,31 @@ class Configuration:
         'output': {
             'visualizers': 'CellStateVisualizer',
             'directory': 'out/',
+            'render_workers': 0,
+            'render_queue': 16,
+        },
+        'ensemble': {
+            'members': 0,
+            'quantiles': '0.05 0.5 0.95',
+            'directory': 'ensemble',
+        },
+        'checkpoint': {
+            'interval': 0,
+            'name': 'checkpoint.npz',
         },
     }
 
-    def __init__(self, config_file, seed=None):
+    def __init__(self, config_file, seed=None, values: dict = None):
         logger = logging.getLogger("Configuration")
 
         self.config_file = config_file
         self.config = configparser.ConfigParser()
-        self.config.read(config_file)
-        logger.info(f"Finished reading {config_file}")
+        if config_file is not None:
+            self.config.read(config_file)
+            logger.info(f"Finished reading {config_file}")
+        # options given as sections like in the config file, they override the file
+        if values:
+            self.config.read_dict({section: {option: ' '.join(map(str, value)) if isinstance(value, (list, tuple)) else value for option, value in options.items()} for section, options in values.items()})
 
         # Simulation settings
         size = self.config.getint('simulation', 'size', fallback=self.DEFAULTS['simulation']['size'])
@@ -50,11 +74,20 @@ class Configuration:
         ## Preset settings
         self.preset_source = self.config.get('preset', 'source', fallback=self.DEFAULTS['preset']['source'])
         self.preset_file = self.config.get('preset', 'file', fallback=self.DEFAULTS['preset']['file'])
+        # check the value ranges of a preset file, false skips the pass over the file
+        self.preset_validate = self.config.getboolean('preset', 'validate', fallback=self.DEFAULTS['preset']['validate'])
         logger.debug(f"config.preset_source = {self.preset_source}")
         logger.debug(f"config.preset_file = {self.preset_file}")
+        logger.debug(f"config.preset_validate = {self.preset_validate}")
 
         ## Neighborhood and rules
         self.neighborhood= self.config.get('simulation', 'neighborhood', fallback=self.DEFAULTS['simulation']['neighborhood'])
+        # cells the neighborhood reaches in every direction, only used by the MooreNeighborhood
+        self.radius = self.config.getint('simulation', 'radius', fallback=self.DEFAULTS['simulation']['radius'])
+        # values of the cells outside the grid (one of: zero, periodic, reflective)
+        self.boundary = self.config.get('simulation', 'boundary', fallback=self.DEFAULTS['simulation']['boundary'])
+        # storage of the state (one of: plain, ghost)
+        self.layout = self.config.get('simulation', 'layout', fallback=self.DEFAULTS['simulation']['layout'])
         self.rules = self.config.get('simulation', 'rules', fallback=self.DEFAULTS['simulation']['rules']).split(' ')
         # new: rule approach (one of: general, individual, stochastic)
         self.rule_approach = self.config.get('simulation', 'rule_approach', fallback=self.DEFAULTS['simulation']['rule_approach'])
@@ -65,8 +98,21 @@ class Configuration:
         self.t_oxygen = self.config.getint('simulation', 't_oxygen', fallback=self.DEFAULTS['simulation']['t_oxygen'])
         self.pb = self.config.getfloat('simulation', 'pb', fallback=self.DEFAULTS['simulation']['pb'])
         self.po = self.config.getfloat('simulation', 'po', fallback=self.DEFAULTS['simulation']['po'])
+        # engine applying the rules (one of: sequential, fused)
+        self.engine = self.config.get('simulation', 'engine', fallback=self.DEFAULTS['simulation']['engine'])
+        # dtype policy of the state (one of: default, compact)
+        self.dtype = self.config.get('simulation', 'dtype', fallback=self.DEFAULTS['simulation']['dtype'])
+        # size of the tiles tracked for activity, 0 disables the tracking
+        self.tile_size = self.config.getint('simulation', 'tile_size', fallback=self.DEFAULTS['simulation']['tile_size'])
+        # active fraction of the tiles from which the full grid is stepped at once
+        self.tile_threshold = self.config.getfloat('simulation', 'tile_threshold', fallback=self.DEFAULTS['simulation']['tile_threshold'])
+        # worker processes of the parallel engine, 0 uses one per CPU
+        self.workers = self.config.getint('simulation', 'workers', fallback=self.DEFAULTS['simulation']['workers'])
 
         logger.debug(f"config.neighborhood = {self.neighborhood}")
+        logger.debug(f"config.radius = {self.radius}")
+        logger.debug(f"config.boundary = {self.boundary}")
+        logger.debug(f"config.layout = {self.layout}")
         logger.debug(f"config.rules = {self.rules}")
         logger.debug(f"config.rule_approach = {self.rule_approach}")
         logger.debug(f"config.threshold_sum = {self.threshold_sum}")
@@ -75,12 +121,39 @@ class Configuration:
         logger.debug(f"config.t_oxygen = {self.t_oxygen}")
         logger.debug(f"config.pb = {self.pb}")
         logger.debug(f"config.po = {self.po}")
+        logger.debug(f"config.engine = {self.engine}")
+        logger.debug(f"config.dtype = {self.dtype}")
+        logger.debug(f"config.tile_size = {self.tile_size}")
+        logger.debug(f"config.tile_threshold = {self.tile_threshold}")
+        logger.debug(f"config.workers = {self.workers}")
+
+        # Ensemble settings
+        self.members = self.config.getint('ensemble', 'members', fallback=self.DEFAULTS['ensemble']['members'])
+        self.quantiles = [float(q) for q in self.config.get('ensemble', 'quantiles', fallback=self.DEFAULTS['ensemble']['quantiles']).split(' ')]
+        logger.debug(f"config.members = {self.members}")
+        logger.debug(f"config.quantiles = {self.quantiles}")
+
+        # Checkpoint settings, an interval of 0 disables checkpoints
+        self.checkpoint_interval = self.config.getint('checkpoint', 'interval', fallback=self.DEFAULTS['checkpoint']['interval'])
+        self.checkpoint_name = self.config.get('checkpoint', 'name', fallback=self.DEFAULTS['checkpoint']['name'])
+        logger.debug(f"config.checkpoint_interval = {self.checkpoint_interval}")
+        logger.debug(f"config.checkpoint_name = {self.checkpoint_name}")
 
         # Visulization settings
-        self.visualizers = self.config.get('output', 'visualizers', fallback=self.DEFAULTS['output']['visualizers']).split(' ')
+        self.visualizers = self.config.get('output', 'visualizers', fallback=self.DEFAULTS['output']['visualizers']).split()
         self.output_dir = self.config.get('output', 'directory', fallback=self.DEFAULTS['output']['directory'])
         logger.debug(f"config.visualizers = {self.visualizers}")
+        # background threads rendering the image frames, 0 renders them in the simulation loop
+        self.render_workers = self.config.getint('output', 'render_workers', fallback=self.DEFAULTS['output']['render_workers'])
+        self.render_queue = self.config.getint('output', 'render_queue', fallback=self.DEFAULTS['output']['render_queue'])
         logger.debug(f"config.output_dir = {self.output_dir}")
+        logger.debug(f"config.render_workers = {self.render_workers}")
+        logger.debug(f"config.render_queue = {self.render_queue}")
+
+    @classmethod
+    def from_dict(cls, values: dict, seed=None) -> Configuration:
+        # without a config file, e.g. {'simulation': {'size': 100, 'rules': [...]}, 'output': {'visualizers': ''}}
+        return cls(None, seed=seed, values=values)
 
     def get(self, *args, **kwargs):
         return self.config.get(*args, **kwargs)
@@ -88,6 +161,14 @@ class Configuration:
     def getint(self, *args, **kwargs):
         return self.config.getint(*args, **kwargs)
 
+    def getboolean(self, *args, **kwargs):
+        return self.config.getboolean(*args, **kwargs)
+
+    def set(self, section, option, value):
+        if not self.config.has_section(section):
+            self.config.add_section(section)
+        self.config.set(section, option, str(value))
+
     def __str__(self) -> str:
         return (
             'Configuration('
@@ -96,7 +177,11 @@ class Configuration:
             f'seed={self.seed}, '
             f'preset_source={self.preset_source}, '
             f'preset_file={self.preset_file}, '
+            f'preset_validate={self.preset_validate}, '
             f'neighborhood={self.neighborhood}, '
+            f'radius={self.radius}, '
+            f'boundary={self.boundary}, '
+            f'layout={self.layout}, '
             f'rules={self.rules}, '
             f'rule_approach={self.rule_approach}, '
             f'threshold_sum={self.threshold_sum}, '
@@ -105,7 +190,18 @@ class Configuration:
             f't_oxygen={self.t_oxygen}, '
             f'pb={self.pb}, '
             f'po={self.po}, '
+            f'engine={self.engine}, '
+            f'dtype={self.dtype}, '
+            f'tile_size={self.tile_size}, '
+            f'tile_threshold={self.tile_threshold}, '
+            f'workers={self.workers}, '
+            f'members={self.members}, '
+            f'quantiles={self.quantiles}, '
+            f'checkpoint_interval={self.checkpoint_interval}, '
+            f'checkpoint_name={self.checkpoint_name}, '
             f'visualizers={self.visualizers}, '
             f'output_dir={self.output_dir}, '
+            f'render_workers={self.render_workers}, '
+            f'render_queue={self.render_queue}, '
             ')'
         )
\ No newline at end of file
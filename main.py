@@ -4,6 +4,8 @@ import os
 import shutil
 import sys
 from config import Configuration
+from sim.ensemble import EnsembleSimulation
+from sim.profiler import Profiler
 from sim.simulation import Simulation
 from pathlib import Path
 
@@ -20,11 +22,19 @@ def yes_no_prompt(question: str) -> bool:
     return False
 
 
-def main(config_file: str, seed: int):
+def main(config_file: str, seed: int, resume: bool, profile: bool, profile_csv: str):
     config = Configuration(config_file, seed=seed)
 
     output_dir = Path(config.output_dir)
-    if output_dir.exists():
+    checkpoint = output_dir / config.checkpoint_name
+    if resume:
+        if config.members > 0:
+            print("Error: Ensembles can not be resumed.", file=sys.stderr)
+            exit(1)
+        if not checkpoint.is_file():
+            print(f"Error: No checkpoint '{checkpoint.absolute()}' to resume from.", file=sys.stderr)
+            exit(1)
+    elif output_dir.exists():
         if output_dir.is_dir():
             if yes_no_prompt(f"Output directory '{output_dir.absolute()}' does already exist. Delete?"):
                 print("Deleted :)")
@@ -36,9 +46,22 @@ def main(config_file: str, seed: int):
             print("Error: '{output_dir.absolute()}' exists and is not a directory.", file=sys.stderr)
             exit(1)
 
+    profiler = Profiler() if profile or profile_csv else None
+
     logger.debug("Starting simulation")
-    sim = Simulation(config)
-    sim.run()
+    if config.members > 0:
+        sim = EnsembleSimulation(config, profiler)
+        sim.run()
+    else:
+        sim = Simulation(config, profiler)
+        sim.run(resume=resume)
+
+    if profiler is not None:
+        summary = profiler.summary()
+        logger.info(f"Profile:\n{summary}")
+        print(summary)
+        if profile_csv:
+            profiler.save(profile_csv)
 
 
 if __name__ == "__main__":
@@ -46,9 +69,12 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--config", help="Path to the configuration file (default: sim.ini)", type=str, default="sim.ini")
     parser.add_argument("-d", "--debug", help="Debug mode with the given log level", type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='INFO')
     parser.add_argument("--seed", help="Seed used for random values", type=int)
+    parser.add_argument("--resume", help="Resume the simulation from the checkpoint in the output directory", action="store_true")
+    parser.add_argument("--profile", help="Time the phases of every step and print a summary at the end", action="store_true")
+    parser.add_argument("--profile-csv", help="Save the profiled times of every step to the given CSV file (implies --profile)", type=str)
     args = parser.parse_args()
 
     log_level = getattr(logging, args.debug.upper(), logging.INFO)
     logging.basicConfig(filename="sim.log", level=log_level)
 
-    main(args.config, args.seed)
+    main(args.config, args.seed, args.resume, args.profile, args.profile_csv)
@@ -0,0 +1,36 @@
+import argparse
+import logging
+import signal
+from config import Configuration
+from sim.service import SimulationService
+
+logger = logging.getLogger("service")
+
+
+def main(config_file: str, socket: str, port: int, processes: int):
+    config = Configuration(config_file)
+
+    service = SimulationService(config, socket, port, processes)
+    # stopped like on Ctrl+C when the daemon is terminated
+    signal.signal(signal.SIGTERM, signal.getsignal(signal.SIGINT))
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        logger.info("Interrupted")
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", help="Path to the configuration the jobs override (default: sim.ini)", type=str, default="sim.ini")
+    parser.add_argument("-d", "--debug", help="Debug mode with the given log level", type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='INFO')
+    parser.add_argument("-s", "--socket", help="Serve on this unix socket instead of HTTP on localhost", type=str)
+    parser.add_argument("--port", help="Port of the HTTP server on localhost", type=int)
+    parser.add_argument("-p", "--processes", help="Number of worker processes, 0 uses one per CPU", type=int)
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.debug.upper(), logging.INFO)
+    logging.basicConfig(filename="service.log", level=log_level)
+
+    main(args.config, args.socket, args.port, args.processes)
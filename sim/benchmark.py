@@ -0,0 +1,227 @@
+import copy
+import itertools
+import json
+import logging
+import numpy as np
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from config import Configuration
+from datetime import datetime
+from pathlib import Path
+from visual.backend import PLT, PNG, PPM
+from visual.statistics import Statistics
+from visual.visualizer import TrajectoryVisualizer, VisualizerContainer
+
+from .engine import EngineGenerator, FusedKernel
+from .neighborhood import NeighborhoodGenerator, NeighborhoodWorkspace
+from .preset import PresetGenerator
+from .rule import RuleGenerator
+from .state import State
+
+logger = logging.getLogger("Benchmark")
+
+
+class Benchmark:
+    """
+    Times the building blocks of a simulation across grid sizes.
+
+    Every case is run a number of times on a fresh copy of its input and
+    the minimum and median wall times are reported. The rules and the
+    steps of the engines are timed for every rule approach, in their
+    sequential and fused variants. The steps are timed for both layouts.
+    """
+
+    SIZES = (100, 256, 1024, 4096)
+    APPROACHES = ('general', 'individual', 'stochastic')
+    PRESETS = ('random', 'firewall', 'spark')
+    RULES = (
+        'DecreaseWhenFireRule',
+        'IncreaseHotForNeighborRule',
+        'IncreaseHeatExactlyOneFireRule',
+        'IncreaseHeatMoreThanOneFireRule',
+        'IncreaseOxygenIfNeighborsHigherRule',
+        'VegetationToHotRule',
+        'CellOnFireRule',
+        'DecreaseHeatInIncombustibleRule',
+        'RegenerateFromBurntOutRule',
+        'IncombustibleToVegetationRule',
+    )
+    # engines timed for whole steps, the parallel engine is left out as it starts processes
+    ENGINES = ('sequential', 'fused')
+    LAYOUTS = ('plain', 'ghost')
+    VISUALIZERS = (
+        'CellStateVisualizer',
+        'FullVisualizer',
+        'HeatPlotVisualizer',
+        'AllAttributePlotVisualizer',
+        'TrajectoryVisualizer',
+        'StatisticsVisualizer',
+    )
+    # steps simulated before timing, so the grid contains all states
+    WARMUP_STEPS = 3
+
+    def __init__(self, config: Configuration, sizes=SIZES, approaches=APPROACHES, repeat: int = 5, scaling: int = 1):
+        self.config = copy.deepcopy(config)
+        self.config.visualizers = []
+        self.config.members = 0
+        self.config.tile_size = 0
+        self.config.steps = repeat + 1
+        if self.config.preset_source == 'file':
+            # the grid sizes are given by the benchmark, not by the file
+            self.config.preset_source = 'random'
+        self.sizes = sizes
+        self.approaches = approaches
+        self.repeat = repeat
+        self.scaling = scaling
+
+    def configure(self, size: int, approach: str) -> Configuration:
+        config = copy.deepcopy(self.config)
+        config.width = size
+        config.height = size
+        config.rule_approach = approach
+        return config
+
+    def time(self, func, setup=None) -> dict:
+        # func(*setup()) is timed, setup is not
+        times = []
+        for i in range(self.repeat + 1):
+            args = setup() if setup is not None else ()
+            start = time.perf_counter()
+            func(*args)
+            end = time.perf_counter()
+            # the first run only warms up caches and buffers
+            if i > 0:
+                times.append(end - start)
+        return {'min': min(times), 'median': statistics.median(times), 'repeat': self.repeat}
+
+    def warm_state(self, config: Configuration) -> State:
+        state = PresetGenerator.get(config).generate()
+        rules = RuleGenerator.get(config)
+        kernel = FusedKernel(rules)
+        neighborhood = NeighborhoodGenerator.get(config, NeighborhoodWorkspace(config, RuleGenerator.neighborhood_fields(rules)))
+        for _ in range(self.WARMUP_STEPS):
+            state = kernel.calculate(state, neighborhood.calculate(state))
+        return state
+
+    def cases(self, size: int, output_dir: Path):
+        # (name, approach, func, setup) of every case of a grid size
+        base = self.configure(size, self.approaches[0])
+        state = self.warm_state(base)
+        fresh = lambda: (copy.deepcopy(state),)
+
+        for preset in self.PRESETS:
+            config = copy.deepcopy(base)
+            config.preset_source = preset
+            yield f"preset/{preset}", None, PresetGenerator.get(config).generate, None
+
+        neighborhood = NeighborhoodGenerator.get(base, NeighborhoodWorkspace(base))
+        yield f"neighborhood/{type(neighborhood).__name__}", None, lambda: neighborhood.calculate(state), None
+        nbs = copy.deepcopy(neighborhood.calculate(state))
+
+        for approach in self.approaches:
+            config = self.configure(size, approach)
+            for name in self.RULES:
+                config.rules = [name]
+                rule = RuleGenerator.get(config)[0]
+                kernel = FusedKernel([rule])
+
+                yield f"rule/{name}/calculate", approach, lambda state, rule=rule: rule.calculate(state, nbs), fresh
+                yield f"rule/{name}/fused", approach, lambda state, rule=rule, kernel=kernel: rule.fused(state, nbs, kernel), fresh
+
+            # whole steps, the fused kernel has to beat the chain of rules it replaces
+            for name, layout in itertools.product(self.ENGINES, self.LAYOUTS):
+                config = self.configure(size, approach)
+                config.engine = name
+                config.layout = layout
+                rules = RuleGenerator.get(config)
+                neighborhood = NeighborhoodGenerator.get(config, NeighborhoodWorkspace(config, RuleGenerator.neighborhood_fields(rules)))
+                engine = EngineGenerator.get(config, neighborhood, rules)
+                # copies keep the layout of the state they are made from
+                arranged = copy.deepcopy(state)
+                neighborhood.arrange(arranged)
+                yield f"engine/{type(engine).__name__}/{layout}/step", approach, lambda state, engine=engine: engine.step(state), lambda arranged=arranged: (copy.deepcopy(arranged),)
+
+        stats = Statistics(base)
+        yield "statistics/record", None, lambda: stats.record(state, 0), None
+
+        config = copy.deepcopy(base)
+        config.output_dir = str(output_dir)
+        config.visualizers = list(self.VISUALIZERS)
+        for name in self.VISUALIZERS:
+            config.set(name, 'scaling', self.scaling)
+            config.set(name, 'video', '')
+        container = VisualizerContainer(config)
+        for vis in container.visualizers:
+            def frame(vis=vis):
+                if container.statistics is not None:
+                    container.statistics.record(state, vis.frame_id)
+                vis.frame(state)
+                vis.advance(vis.frame_id)
+            yield f"visualizer/{type(vis).__name__}/frame", None, frame, None
+        # the plots are only drawn when the visualizers finish
+        for vis in container.visualizers:
+            # finish closes the recording, it is opened again with a frame left to flush
+            def record(vis=vis):
+                vis.frame(state)
+                return ()
+            setup = record if isinstance(vis, TrajectoryVisualizer) else None
+            yield f"visualizer/{type(vis).__name__}/finish", None, vis.finish, setup
+
+        pixels = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+        for backend, suffix in ((PPM(), ".ppm"), (PNG(), ".png")):
+            path = output_dir / f"backend{suffix}"
+            yield f"backend/{type(backend).__name__}", None, lambda backend=backend, path=path: backend.write(path, pixels, scaling=self.scaling), None
+        series = np.arange(size)
+        plot = PLT()
+        yield "backend/PLT", None, lambda: plot.write(output_dir / "backend_plot.png", series, series), None
+
+    def run(self) -> list:
+        results = []
+        output_dir = Path(tempfile.mkdtemp(prefix="benchmark-"))
+        try:
+            for size in self.sizes:
+                for name, approach, func, setup in self.cases(size, output_dir):
+                    result = {'case': name, 'size': size, 'approach': approach, **self.time(func, setup)}
+                    results.append(result)
+                    logger.info(f"{name} size={size} approach={approach}: {result['median'] * 1e3:.3f} ms")
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        return results
+
+    def save(self, results: list, path: Path) -> None:
+        report = {
+            'meta': {
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'dtype': self.config.dtype,
+                'repeat': self.repeat,
+                'scaling': self.scaling,
+            },
+            'results': results,
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=4)
+        logger.info(f"Saved benchmark results to {path}")
+
+
+def compare(results: list, baseline: list, threshold: float) -> list:
+    """
+    Cases whose median time grew by more than `threshold` (relative) compared to the baseline.
+    Returns (result, baseline result, ratio) of every regression.
+    """
+    key = lambda r: (r['case'], r['size'], r['approach'])
+    base = {key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = base.get(key(result))
+        if old is None or old['median'] <= 0:
+            continue
+        ratio = result['median'] / old['median']
+        if ratio > 1 + threshold:
+            regressions.append((result, old, ratio))
+    return regressions
@@ -0,0 +1,67 @@
+import logging
+import numpy as np
+import os
+from pathlib import Path
+
+from .state import State
+
+
+def pack_rng(rng: np.random.RandomState) -> dict:
+    kind, keys, pos, has_gauss, gauss = rng.get_state()
+    return {'keys': keys, 'pos': np.array(pos), 'has_gauss': np.array(has_gauss), 'gauss': np.array(gauss)}
+
+
+def unpack_rng(rng: np.random.RandomState, data: dict) -> None:
+    rng.set_state(('MT19937', data['keys'], int(data['pos']), int(data['has_gauss']), float(data['gauss'])))
+
+
+class Checkpoint:
+    """
+    Everything needed to resume a simulation bit-identically.
+
+    The state, the step counter and whatever the rules, visualizers and
+    convergence monitor report through their checkpoint() methods are
+    saved to a single uncompressed .npz file. Writes go to a temporary
+    file that replaces the checkpoint, so a crash never leaves a broken
+    checkpoint behind.
+    """
+
+    ATTRIBUTES = ('heat', 'fuel', 'oxygen', 'cell_state', 'time_since_burnt_out')
+
+    def __init__(self, path: Path):
+        self.logger = logging.getLogger("Checkpoint")
+        self.path = Path(path)
+
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    def save(self, step: int, state: State, rules: list, visualizers: list, monitors: list = ()) -> None:
+        data = {'step': np.array(step)}
+        for attr in self.ATTRIBUTES:
+            data[f'state.{attr}'] = getattr(state, attr)
+        for prefix, objs in (('rule', rules), ('visualizer', visualizers), ('monitor', monitors)):
+            for i, obj in enumerate(objs):
+                for key, value in obj.checkpoint().items():
+                    data[f'{prefix}{i}.{key}'] = value
+
+        os.makedirs(self.path.parent, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.logger.debug(f"Saved checkpoint of step {step} to {self.path}")
+
+    def load(self, state: State, rules: list, visualizers: list, monitors: list = ()) -> int:
+        # restore everything in place, returns the step the checkpoint was taken at
+        with np.load(self.path) as data:
+            for attr in self.ATTRIBUTES:
+                setattr(state, attr, data[f'state.{attr}'])
+            for prefix, objs in (('rule', rules), ('visualizer', visualizers), ('monitor', monitors)):
+                for i, obj in enumerate(objs):
+                    start = f'{prefix}{i}.'
+                    obj.restore({key[len(start):]: data[key] for key in data.files if key.startswith(start)})
+            step = int(data['step'])
+        self.logger.debug(f"Loaded checkpoint of step {step} from {self.path}")
+        return step
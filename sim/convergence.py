@@ -0,0 +1,224 @@
+import copy
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+from collections import deque
+from config import Configuration
+from pathlib import Path
+
+from .state import State
+
+
+class ConvergenceMonitor:
+    """
+    Ends a run early once the simulation can not change anymore.
+
+    A state is steady when it repeats exactly, as a fixed point or a cycle.
+    Repeats are found by hashing the state after every step. They are only
+    trusted if no rule drew random numbers for the states in between, so
+    the stochastic approach is only checked once the fire is out. Instead
+    of stopping, a steady run can be forwarded by replaying its cycle.
+
+    The state is hashed in strips of rows. A copy of the last hashed state
+    tells which strips changed, only those are copied and hashed again.
+    The digest of the state is the hash of the digests of its strips.
+    """
+
+    ATTRIBUTES = ('heat', 'fuel', 'oxygen', 'cell_state', 'time_since_burnt_out')
+    # rows of a strip hashed on its own
+    STRIP_ROWS = 16
+    DIGEST_SIZE = 16
+
+    DEFAULT_CONFIG = {
+        'enabled': False,
+        'condition': 'steady',
+        'after': 'stop',
+        'period': 1024,
+        'name': 'convergence.json',
+    }
+
+    def __init__(self, config: Configuration, rules: list):
+        self.logger = logging.getLogger("ConvergenceMonitor")
+        self.config = config
+        self.rules = rules
+
+        self.condition = config.get('convergence', 'condition', fallback=self.DEFAULT_CONFIG['condition'])
+        if self.condition not in ('steady', 'extinct'):
+            self.logger.error(f"Invalid condition {self.condition} -> fallback to steady")
+            self.condition = 'steady'
+        self.after = config.get('convergence', 'after', fallback=self.DEFAULT_CONFIG['after'])
+        if self.after not in ('stop', 'forward'):
+            self.logger.error(f"Invalid after {self.after} -> fallback to stop")
+            self.after = 'stop'
+        # longest cycle detected
+        self.period = max(1, config.getint('convergence', 'period', fallback=self.DEFAULT_CONFIG['period']))
+
+        # hash -> step of the recent states without random updates
+        self.hashes = {}
+        self.history = deque()
+        # copy of the last hashed state and the digests of its strips per attribute
+        self.reference = None
+        self.digests = None
+
+        self.reason = None
+        self.step = None
+        self.cycle_period = None
+        # snapshots of the cycle replayed when forwarding
+        self.cycle = None
+        self.replayed = 0
+
+    @classmethod
+    def enabled(cls, config: Configuration) -> bool:
+        return config.getboolean('convergence', 'enabled', fallback=cls.DEFAULT_CONFIG['enabled'])
+
+    @staticmethod
+    def extinct(state: State) -> bool:
+        # without fire, hot cells and heat nothing can ignite again
+        counts = state.counts()
+        return counts[State.FIRE] == 0 and counts[State.HOT] == 0 and not state.heat.any()
+
+    def random(self, state: State) -> bool:
+        # whether the next step depends on random numbers
+        for rule in self.rules:
+            cells = rule.random_cells(state)
+            if cells is not None and cells.any():
+                return True
+        return False
+
+    def hash(self, state: State) -> bytes:
+        starts = range(0, len(state.cell_state), self.STRIP_ROWS)
+        if self.reference is None:
+            self.reference = {attr: np.empty_like(getattr(state, attr), order='C') for attr in self.ATTRIBUTES}
+            self.digests = {attr: [None] * len(starts) for attr in self.ATTRIBUTES}
+        hasher = hashlib.blake2b(digest_size=self.DIGEST_SIZE)
+        for attr in self.ATTRIBUTES:
+            values = getattr(state, attr)
+            reference = self.reference[attr]
+            digests = self.digests[attr]
+            for i, start in enumerate(starts):
+                strip = slice(start, start + self.STRIP_ROWS)
+                if digests[i] is None or not np.array_equal(values[strip], reference[strip]):
+                    # the strips of the copy are contiguous, also for views of a padded state
+                    np.copyto(reference[strip], values[strip])
+                    digests[i] = hashlib.blake2b(reference[strip], digest_size=self.DIGEST_SIZE).digest()
+                hasher.update(digests[i])
+        return hasher.digest()
+
+    @classmethod
+    def snapshot(cls, state: State) -> State:
+        snapshot = copy.copy(state)
+        for attr in cls.ATTRIBUTES:
+            setattr(snapshot, attr, getattr(state, attr).copy())
+        return snapshot
+
+    def replay(self):
+        # next state of the replayed cycle, None while the steps have to be calculated
+        if self.cycle is None or len(self.cycle) < self.cycle_period:
+            return None
+        state = self.cycle[self.replayed % self.cycle_period]
+        self.replayed += 1
+        return state
+
+    def stopped(self) -> bool:
+        # whether the run ended, a forwarded run goes on
+        return self.reason is not None and (self.condition == 'extinct' or self.after == 'stop')
+
+    def checkpoint(self) -> dict:
+        # the recent hashes and the cycle, so a resumed run ends at the same step
+        data = {
+            'hashes': np.frombuffer(b''.join(self.history), dtype=np.uint8).reshape(-1, self.DIGEST_SIZE),
+            'steps': np.array([self.hashes[digest] for digest in self.history], dtype=np.int64),
+            'reason': np.array(self.reason if self.reason is not None else ''),
+            'step': np.array(self.step if self.step is not None else -1),
+            'period': np.array(self.cycle_period if self.cycle_period is not None else -1),
+            'replayed': np.array(self.replayed),
+        }
+        if self.cycle is not None:
+            for attr in self.ATTRIBUTES:
+                data[f'cycle.{attr}'] = np.stack([getattr(snapshot, attr) for snapshot in self.cycle])
+        return data
+
+    def restore(self, data: dict) -> None:
+        if not data:
+            # checkpoint saved without a monitor, the history starts over
+            return
+        self.history = deque(digest.tobytes() for digest in data['hashes'])
+        self.hashes = dict(zip(self.history, data['steps'].tolist()))
+        self.reason = str(data['reason']) or None
+        self.step = int(data['step']) if data['step'] >= 0 else None
+        self.cycle_period = int(data['period']) if data['period'] >= 0 else None
+        self.replayed = int(data['replayed'])
+        self.cycle = None
+        if 'cycle.cell_state' in data:
+            self.cycle = []
+            for i in range(len(data['cycle.cell_state'])):
+                snapshot = State(*(data[f'cycle.{attr}'][i].copy() for attr in ('heat', 'fuel', 'oxygen', 'cell_state')))
+                snapshot.time_since_burnt_out = data['cycle.time_since_burnt_out'][i].copy()
+                self.cycle.append(snapshot)
+
+    def update(self, state: State, step: int) -> bool:
+        # called after every step, True if the run should stop now
+        if self.cycle is not None:
+            # collect the states of the cycle, they are replayed afterwards
+            if len(self.cycle) < self.cycle_period:
+                self.cycle.append(self.snapshot(state))
+            return False
+
+        if self.condition == 'extinct':
+            if self.extinct(state):
+                self.converged('extinct', step)
+                return True
+            return False
+
+        if self.random(state):
+            # random updates may break any repeat found so far
+            self.hashes.clear()
+            self.history.clear()
+            return False
+
+        digest = self.hash(state)
+        seen = self.hashes.get(digest)
+        if seen is not None:
+            period = step - seen
+            self.converged('steady' if period == 1 else 'cycle', step, period)
+            if self.after == 'stop':
+                return True
+            self.cycle = [self.snapshot(state)]
+            self.logger.info(f"Forwarding the remaining steps with the cycle of {period} steps")
+            return False
+
+        self.hashes[digest] = step
+        self.history.append(digest)
+        if len(self.history) > self.period:
+            del self.hashes[self.history.popleft()]
+        return False
+
+    def converged(self, reason: str, step: int, period: int = None) -> None:
+        self.reason = reason
+        self.step = step
+        self.cycle_period = period
+        if period is not None:
+            self.logger.info(f"State is {reason} at step {step} with a period of {period} steps")
+        else:
+            self.logger.info(f"State is {reason} at step {step}")
+
+    def get_output_path(self) -> Path:
+        output_dir = Path(self.config.output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+        return output_dir / self.config.get('convergence', 'name', fallback=self.DEFAULT_CONFIG['name'])
+
+    def save(self, last_step: int) -> None:
+        # why and when the run ended, 'steps' if it ran all steps without converging
+        result = {
+            'reason': self.reason if self.reason is not None else 'steps',
+            'step': self.step,
+            'period': self.cycle_period,
+            'forwarded': self.replayed,
+            'last_step': last_step,
+        }
+        output_path = self.get_output_path()
+        with open(output_path, "w") as f:
+            json.dump(result, f, indent=4)
+        self.logger.info(f"Saved convergence to {output_path}")
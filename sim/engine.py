@@ -0,0 +1,316 @@
+import logging
+import numpy as np
+from abc import ABC, abstractmethod
+from config import Configuration
+
+from .neighborhood import Neighborhood
+from .state import State
+
+class EngineGenerator:
+    @classmethod
+    def get(cls, config: Configuration, neighborhood: Neighborhood, rules: list) -> Engine:
+        logger = logging.getLogger("EngineGenerator")
+        engine: Engine = None
+        if config.engine == "sequential":
+            engine = SequentialEngine(config, neighborhood, rules)
+            logger.debug("SequentialEngine chosen")
+        elif config.engine == "fused":
+            engine = FusedEngine(config, neighborhood, rules)
+            logger.debug("FusedEngine chosen")
+        elif config.engine == "parallel" and config.members > 0:
+            engine = FusedEngine(config, neighborhood, rules)
+            logger.error("Ensembles are not supported by the ParallelEngine -> fallback to FusedEngine")
+        elif config.engine == "parallel" and neighborhood.boundary.mode != 'zero':
+            engine = FusedEngine(config, neighborhood, rules)
+            logger.error(f"The {neighborhood.boundary.mode} boundary is not supported by the ParallelEngine -> fallback to FusedEngine")
+        elif config.engine == "parallel":
+            # imported here, the parallel module builds upon this one
+            from .parallel import ParallelEngine
+            engine = ParallelEngine(config, neighborhood, rules)
+            logger.debug("ParallelEngine chosen")
+        else:
+            engine = SequentialEngine(config, neighborhood, rules)
+            logger.error("No or invalid engine given -> fallback to SequentialEngine")
+
+        # the engine actually built, the ParallelEngine may have fallen back to the FusedEngine
+        if config.tile_size > 0 and not isinstance(engine, InProcessEngine):
+            logger.error(f"Active tiles are not supported by the {type(engine).__name__} -> tile_size ignored")
+        elif config.tile_size > 0 and config.members > 0:
+            logger.error("Active tiles are not supported for ensembles -> tile_size ignored")
+        elif config.tile_size > 0:
+            engine = ActiveTileEngine(config, engine)
+            logger.debug(f"ActiveTileEngine chosen with tile size {config.tile_size}")
+        return engine
+
+
+class Engine(ABC):
+    # Advance the state by one step of the neighborhood and the rules.
+    def __init__(self, config: Configuration, neighborhood: Neighborhood, rules: list):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.config = config
+        self.neighborhood = neighborhood
+        self.rules = rules
+
+    @abstractmethod
+    def step(self, state: State) -> State:
+        pass
+
+    def close(self) -> None:
+        # Release resources held by the engine after the last step.
+        pass
+
+
+class InProcessEngine(Engine):
+    # Calculate the neighborhood and apply the rules to it in this process.
+    def step(self, state: State) -> State:
+        nbs = self.neighborhood.calculate(state)
+        return self.apply(state, nbs)
+
+    @abstractmethod
+    def apply(self, state: State, nbs: State) -> State:
+        pass
+
+
+class SequentialEngine(InProcessEngine):
+    # Apply every rule on its own, each one allocating fresh arrays.
+    def apply(self, state: State, nbs: State) -> State:
+        for rule in self.rules:
+            state = rule.calculate(state, nbs)
+        return state
+
+
+class FusedEngine(InProcessEngine):
+    # Apply all rules in a single in-place pass over preallocated buffers.
+    def __init__(self, config: Configuration, neighborhood: Neighborhood, rules: list):
+        super().__init__(config, neighborhood, rules)
+        self.kernel = FusedKernel(rules)
+        self.logger.debug(f"Compiled {len(rules)} rules into one kernel")
+
+    def apply(self, state: State, nbs: State) -> State:
+        return self.kernel.calculate(state, nbs)
+
+
+class ActiveTileEngine(InProcessEngine):
+    """
+    Only apply the neighborhood and rules to tiles that can change.
+
+    A tile is run if it or one of its four neighboring tiles changed in
+    the previous step, or if it contains cells with a random update.
+    For the MooreNeighborhood the diagonal tiles and, for radii larger
+    than the tiles, further tiles within reach count as neighbors.
+    With periodic boundaries the tiles at opposite edges are neighbors.
+    Rules are local and deterministic otherwise, so a tile whose cells and
+    halo did not change maps to itself again and can be skipped. The
+    results are the same as running the wrapped engine on the full grid.
+
+    Every tile costs a round of NumPy calls, so once the active fraction
+    reaches the threshold the full grid is stepped at once and the changed
+    tiles are found from one comparison of the whole grid.
+    """
+
+    # the attributes most likely to change first, the comparison stops at the first change
+    ATTRIBUTES = ('cell_state', 'heat', 'oxygen', 'fuel', 'time_since_burnt_out')
+
+    def __init__(self, config: Configuration, engine: InProcessEngine):
+        super().__init__(config, engine.neighborhood, engine.rules)
+        self.engine = engine
+        self.tile_size = config.tile_size
+        self.threshold = config.tile_threshold
+        # copies of the attributes before the step, per tile and for full steps
+        self.buffers = {}
+
+        self.starts_x = np.arange(0, config.width, self.tile_size)
+        self.starts_y = np.arange(0, config.height, self.tile_size)
+        # every tile has to be run in the first step
+        self.changed = np.ones((len(self.starts_x), len(self.starts_y)), dtype=bool)
+        self.active_fractions = []
+        # tiles a change reaches, the last tiles may be narrower than the others
+        narrowest = min(self.tile_size, config.width - self.starts_x[-1], config.height - self.starts_y[-1])
+        self.reach = -(-self.neighborhood.radius // narrowest)
+        self.periodic = self.neighborhood.boundary.mode == 'periodic'
+
+    def tile(self, i: int, j: int) -> tuple:
+        x = self.starts_x[i]
+        y = self.starts_y[j]
+        return (slice(x, min(x + self.tile_size, self.config.width)), slice(y, min(y + self.tile_size, self.config.height)))
+
+    def active_tiles(self, state: State) -> np.ndarray:
+        # tiles that changed and the tiles within reach of the neighborhood
+        active = self.changed
+        if self.neighborhood.DIAGONAL:
+            for _ in range(self.reach):
+                active = self.grow(self.grow(active, 0), 1)
+        else:
+            active = self.grow(active, 0) | self.grow(active, 1)
+
+        # tiles with cells whose next state depends on random numbers
+        for rule in self.rules:
+            random = rule.random_cells(state)
+            if random is not None:
+                random = np.logical_or.reduceat(random, self.starts_x, axis=0)
+                active |= np.logical_or.reduceat(random, self.starts_y, axis=1)
+        return active
+
+    def grow(self, tiles: np.ndarray, axis: int) -> np.ndarray:
+        # tiles and their neighbors along an axis, wrapping around for periodic boundaries
+        grown = tiles.copy()
+        if self.periodic:
+            grown |= np.roll(tiles, 1, axis)
+            grown |= np.roll(tiles, -1, axis)
+        elif axis == 0:
+            grown[1:] |= tiles[:-1]
+            grown[:-1] |= tiles[1:]
+        else:
+            grown[:, 1:] |= tiles[:, :-1]
+            grown[:, :-1] |= tiles[:, 1:]
+        return grown
+
+    def buffer(self, name: str, shape: tuple, dtype) -> np.ndarray:
+        key = (name, np.dtype(dtype))
+        buf = self.buffers.get(key)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buf
+        return buf
+
+    def step(self, state: State) -> State:
+        active = self.active_tiles(state)
+        self.active_fractions.append(np.count_nonzero(active) / active.size)
+        if self.active_fractions[-1] >= self.threshold:
+            self.logger.debug(f"Active fraction: {self.active_fractions[-1]:.4f} -> full grid")
+            return self.step_full(state)
+        self.logger.debug(f"Active fraction: {self.active_fractions[-1]:.4f}")
+
+        indices = list(zip(*np.nonzero(active)))
+        tiles = [self.tile(i, j) for i, j in indices]
+        for rule in self.rules:
+            rule.begin_step(state)
+        nbs = self.neighborhood.calculate(state, tiles)
+
+        full = (self.tile_size, self.tile_size)
+        self.changed = np.zeros_like(active)
+        for (i, j), tile in zip(indices, tiles):
+            view = state.view(tile)
+            targets = [getattr(view, attr) for attr in self.ATTRIBUTES]
+            before = []
+            for attr, target in zip(self.ATTRIBUTES, targets):
+                # tile sized buffers, the last tiles may be smaller
+                old = self.buffer(attr, full, target.dtype)[:target.shape[0], :target.shape[1]]
+                np.copyto(old, target)
+                before.append(old)
+            res = self.apply(view, nbs.view(tile))
+            for attr, target, old in zip(self.ATTRIBUTES, targets, before):
+                new = getattr(res, attr)
+                if new is not target:
+                    # rules that allocate new arrays write back into the tile
+                    np.copyto(target, new)
+                if not self.changed[i, j] and not np.array_equal(old, target):
+                    self.changed[i, j] = True
+
+        for rule in self.rules:
+            rule.end_step()
+        # the tiles were written in place
+        state.invalidate()
+        return state
+
+    def step_full(self, state: State) -> State:
+        # the wrapped engine on the full grid, the tiles changed are those with a changed cell
+        shape = state.cell_state.shape
+        before = {}
+        for attr in self.ATTRIBUTES:
+            values = getattr(state, attr)
+            before[attr] = self.buffer(f"full_{attr}", shape, values.dtype)
+            np.copyto(before[attr], values)
+        state = self.engine.step(state)
+
+        changed = self.buffer("changed", shape, bool)
+        differs = self.buffer("differs", shape, bool)
+        np.not_equal(before['cell_state'], state.cell_state, out=changed)
+        for attr in self.ATTRIBUTES[1:]:
+            np.not_equal(before[attr], getattr(state, attr), out=differs)
+            np.logical_or(changed, differs, out=changed)
+        changed = np.logical_or.reduceat(changed, self.starts_x, axis=0)
+        self.changed = np.logical_or.reduceat(changed, self.starts_y, axis=1)
+        return state
+
+    def apply(self, state: State, nbs: State) -> State:
+        return self.engine.apply(state, nbs)
+
+    def close(self) -> None:
+        self.engine.close()
+
+
+class FusedKernel:
+    """
+    The rule list compiled into one per-step kernel.
+
+    Every rule contributes its in-place `fused` variant. The kernel owns the
+    scratch buffers the rules write their masks into. The `cell_state == X`
+    masks are cached by the state, rules writing the cell states in place
+    invalidate them. The masked cells are updated with plain arithmetic on
+    the masks by add, subtract and transition: the masked loops of NumPy
+    (`where=`) are several times slower than the whole chain of `np.where`
+    the SequentialEngine allocates.
+    """
+
+    def __init__(self, rules: list):
+        self.rules = rules
+        self.buffers = {}
+
+    def buffer(self, name: str, shape: tuple, dtype=bool) -> np.ndarray:
+        key = (name, shape, np.dtype(dtype))
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buf
+        return buf
+
+    def state_mask(self, state: State, value: int) -> np.ndarray:
+        # Mask of all cells in the given state, calculated into a kernel buffer when invalid.
+        return state.mask(value, out=self.buffer(f"state_{value}", state.cell_state.shape))
+
+    def add(self, values: np.ndarray, mask: np.ndarray, value=1, limit=None) -> None:
+        """
+        Add `value` to the cells of the mask, at most `limit`.
+        All cells are clamped to the limit, the cells outside the mask have to be
+        within it already, like the heat and oxygen of every state. Without a limit
+        the cells stop at the largest value of the dtype.
+        """
+        if limit is None:
+            room = self.buffer("room", values.shape)
+            np.less_equal(values, np.iinfo(values.dtype).max - value, out=room)
+            mask = np.logical_and(mask, room, out=room)
+        increment = self.buffer("increment", values.shape, values.dtype)
+        np.multiply(mask, values.dtype.type(value), out=increment)
+        np.add(values, increment, out=values)
+        if limit is not None:
+            np.minimum(values, limit, out=values)
+
+    def subtract(self, values: np.ndarray, mask: np.ndarray) -> None:
+        # Subtract 1 from the cells of the mask, at least 0. min(values, mask) is
+        # 1 for masked cells of at least 1 and the whole value below, 0 elsewhere.
+        decrement = self.buffer("decrement", values.shape, values.dtype)
+        np.minimum(values, mask, out=decrement)
+        np.subtract(values, decrement, out=values)
+
+    def transition(self, cell_state: np.ndarray, mask: np.ndarray, source: int, target: int) -> None:
+        # Move the cells of the mask, which are all in the source state, to the target state.
+        # Adds the same difference to all of them, a single pass if it is 1.
+        difference = target - source
+        if abs(difference) == 1:
+            step = mask
+        else:
+            step = self.buffer("transition", cell_state.shape, cell_state.dtype)
+            np.multiply(mask, cell_state.dtype.type(abs(difference)), out=step)
+        if difference > 0:
+            np.add(cell_state, step, out=cell_state)
+        else:
+            np.subtract(cell_state, step, out=cell_state)
+
+    def calculate(self, state: State, nbs: State) -> State:
+        for rule in self.rules:
+            state = rule.fused(state, nbs, self)
+        # only the writes to cell_state invalidate in place
+        for source in ('heat', 'fuel', 'oxygen'):
+            state.invalidate(source)
+        return state
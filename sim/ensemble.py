@@ -0,0 +1,108 @@
+import logging
+import numpy as np
+import os
+from config import Configuration
+from pathlib import Path
+
+from .engine import EngineGenerator
+from .neighborhood import NeighborhoodGenerator, NeighborhoodWorkspace
+from .preset import PresetGenerator
+from .profiler import Profiler
+from .rule import RuleGenerator
+from .state import State
+
+
+class EnsembleSimulation:
+    """
+    Monte Carlo ensemble of simulations run as one batched array.
+
+    All members start from the same preset and differ only in the random
+    streams of the stochastic rules. Every attribute of the state has a
+    leading axis with one entry per member, so the neighborhood and the
+    rules update the whole ensemble at once. Instead of visualizers the
+    per-member state counts and the burned area statistics are saved.
+    """
+
+    DEFAULT_DIRECTORY = 'ensemble'
+
+    def __init__(self, config: Configuration, profiler: Profiler = None):
+        self.logger = logging.getLogger("EnsembleSimulation")
+        self.config = config
+        self.members = config.members
+
+        self.preset = PresetGenerator.get(self.config)
+        single = self.preset.generate()
+        batched = [np.repeat(attr[np.newaxis], self.members, axis=0) for attr in (single.heat, single.fuel, single.oxygen, single.cell_state)]
+        self.state = State(*batched, State.get_dtypes(self.config.dtype))
+        self.logger.debug(f"Ensemble of {self.members} members")
+
+        self.rules = RuleGenerator.get(self.config)
+        fields = RuleGenerator.neighborhood_fields(self.rules)
+        self.workspace = NeighborhoodWorkspace(self.config, fields)
+        self.neighborhood = NeighborhoodGenerator.get(self.config, self.workspace)
+        self.neighborhood.arrange(self.state)
+
+        self.engine = EngineGenerator.get(self.config, self.neighborhood, self.rules)
+
+        if self.config.visualizers:
+            self.logger.info("Visualizers are not used for ensembles")
+
+        self.counts = None
+
+        # phases are only timed if a profiler is given
+        self.profiler = profiler
+        if self.profiler is not None:
+            self.profiler.attach(self.engine, self.neighborhood, self.rules)
+
+    def count(self, step: int) -> None:
+        # number of cells in each state per member
+        for i in range(State.STATESCOUNT):
+            np.sum(self.state.mask(i), axis=(-2, -1), out=self.counts[step, :, i])
+
+    def run(self, steps: int = None):
+        steps = steps if steps else self.config.steps
+
+        self.counts = np.zeros((steps + 1, self.members, State.STATESCOUNT), dtype=np.int64)
+        self.count(0)
+
+        try:
+            for step in range(steps):
+                self.state = self.engine.step(self.state)
+                self.count(step + 1)
+                if self.profiler is not None:
+                    self.profiler.end_step(step + 1)
+        finally:
+            self.engine.close()
+
+        self.save()
+
+    def burned_area(self) -> np.ndarray:
+        # burning and burnt out cells per step and member
+        return self.counts[:, :, State.FIRE] + self.counts[:, :, State.INCOMBUSTIBLE]
+
+    def get_output_path(self) -> Path:
+        dir = self.config.get('ensemble', 'directory', fallback=self.DEFAULT_DIRECTORY)
+        path = Path(self.config.output_dir) / dir
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def save(self) -> None:
+        output_path = self.get_output_path()
+        quantiles = self.config.quantiles
+        burned = self.burned_area()
+        burned_mean = burned.mean(axis=1)
+        burned_quantiles = np.quantile(burned, quantiles, axis=1).T
+
+        np.savez_compressed(
+            output_path / "stats.npz",
+            counts=self.counts,
+            burned_area=burned,
+            burned_area_mean=burned_mean,
+            burned_area_quantiles=burned_quantiles,
+            quantiles=np.array(quantiles),
+        )
+
+        header = ["step", "burned_area_mean", *[f"burned_area_q{q}" for q in quantiles]]
+        table = np.column_stack([np.arange(len(burned_mean)), burned_mean, burned_quantiles])
+        np.savetxt(output_path / "stats.csv", table, delimiter=",", header=",".join(header), comments="", fmt="%g")
+        self.logger.info(f"Saved ensemble statistics to {output_path}")
@@ -6,78 +6,388 @@ from .state import State
 
 class NeighborhoodGenerator:
     @classmethod
-    def get(cls, config: Configuration):
+    def get(cls, config: Configuration, workspace: NeighborhoodWorkspace = None):
         logger = logging.getLogger("NeighborhoodGenerator")
         neighborhood = None
         if config.neighborhood == "NeumannNeighborhood":
-            neighborhood = NeumannNeighborhood(config)
+            neighborhood = NeumannNeighborhood(config, workspace)
             logger.debug("Von Neumann neighborhood chosen")
+        elif config.neighborhood == "MooreNeighborhood":
+            neighborhood = MooreNeighborhood(config, workspace)
+            logger.debug(f"Moore neighborhood chosen with radius {neighborhood.radius}")
         else:
-            neighborhood = NeumannNeighborhood(config)
+            neighborhood = NeumannNeighborhood(config, workspace)
             logger.error("No or invalid neighborhood given -> fallback to Von Neumann neighborhood")
         return neighborhood
 
+    @classmethod
+    def radius(cls, config: Configuration) -> int:
+        # cells the configured neighborhood reaches in every direction
+        if config.neighborhood == "MooreNeighborhood":
+            return MooreNeighborhood.get_radius(config)
+        return 1
+
+
+class Boundary:
+    """
+    Fills the cells around the grid according to the boundary condition.
+
+    With `zero` the border is left as it is, zero and OUTSIDE for the cell
+    states. `periodic` wraps the grid around at its edges and `reflective`
+    mirrors the cells at the edges. Only the border rows and columns are
+    written, the interior of the padded array is not touched.
+    """
+
+    MODES = ('zero', 'periodic', 'reflective')
+
+    def __init__(self, config: Configuration, radius: int):
+        logger = logging.getLogger("Boundary")
+        self.mode = config.boundary
+        if self.mode not in self.MODES:
+            logger.error(f"Invalid boundary {self.mode} -> fallback to zero")
+            self.mode = 'zero'
+        self.radius = radius
+        self.width = config.width
+        self.height = config.height
+
+        r = radius
+        # grid row and column every row and column of the padded array is taken from
+        self.source_x = self.sources(self.width)
+        self.source_y = self.sources(self.height)
+        self.rows = np.r_[0:r, self.width + r:self.width + 2*r]
+        self.cols = np.r_[0:r, self.height + r:self.height + 2*r]
+
+    def sources(self, n: int) -> np.ndarray:
+        i = np.arange(-self.radius, n + self.radius)
+        if self.mode == 'periodic':
+            return i % n
+        # reflective, the cell at the edge is mirrored too
+        i = np.where(i < 0, -i - 1, i)
+        return np.where(i >= n, 2*n - 1 - i, i)
+
+    def touches(self, tile) -> bool:
+        # whether the halo of the tile reaches into the border
+        sx, sy = tile
+        r = self.radius
+        return sx.start < r or sy.start < r or sx.stop > self.width - r or sy.stop > self.height - r
+
+    def fill(self, padded, values, tile=None, value=None, compare=np.equal) -> None:
+        # border of the padded array from the values of the grid, or whether they compare to a value
+        if self.mode == 'zero' or (tile is not None and not self.touches(tile)):
+            return
+        r = self.radius
+        # rows above and below the grid over the full width, then the columns beside it
+        rows = values[..., self.source_x[self.rows], :][..., self.source_y]
+        cols = values[..., :, self.source_y[self.cols]]
+        if value is not None:
+            rows = compare(rows, value)
+            cols = compare(cols, value)
+        padded[..., self.rows, :] = rows
+        padded[..., r:self.width + r, self.cols] = cols
+
+
+class NeighborhoodWorkspace:
+    """
+    Buffers of the neighborhood calculation.
+
+    Allocated once and reused every step, so calculating a neighborhood
+    does not allocate. The returned neighborhood State is a view onto
+    these buffers and is overwritten by the next calculation.
+    Only the given fields (default: all) are allocated, the others are None.
+    Ensembles get a leading axis with one entry per member. Neighborhoods
+    needing further scratch arrays allocate them through buffer(), so
+    they are reused with the workspace and counted in nbytes.
+    """
+
+    def __init__(self, config: Configuration, fields=None):
+        width = config.width
+        height = config.height
+        batch = (config.members,) if config.members > 0 else ()
+        count = State.get_dtypes(config.dtype)['count']
+        self.fields = frozenset(fields) if fields is not None else Neighborhood.FIELDS
+        self.radius = NeighborhoodGenerator.radius(config)
+        r = self.radius
+
+        def alloc(field, dtype=count):
+            return np.empty((*batch, width, height), dtype=dtype) if field in self.fields else None
+
+        # padded copy of the attribute currently summed up, the border is only written by boundaries other than zero
+        self.padded = np.zeros((*batch, width+2*r, height+2*r), dtype=count)
+        self.mask = alloc('oxygen_higher_count', bool)
+
+        self.oxygen = alloc('oxygen')
+        self.fuel = alloc('fuel')
+        self.heat = alloc('heat')
+        self.cell_state = [alloc(Neighborhood.STATE_FIELDS[i]) for i in range(State.STATESCOUNT)]
+        self.oxygen_higher_count = alloc('oxygen_higher_count')
+
+        # cell_state holds the per-state counts, neighborhoods have no regeneration timer
+        self.result = State(self.heat, self.fuel, self.oxygen, np.empty(0))
+        self.result.cell_state = self.cell_state
+        self.result.time_since_burnt_out = None
+        # attach helper information to the returned neighborhood State
+        self.result.oxygen_higher_count = self.oxygen_higher_count
+        # scratch arrays of the neighborhoods by name
+        self.buffers = {}
+
+    def buffer(self, name: str, shape: tuple, dtype) -> np.ndarray:
+        # zeroed when allocated, later calls return the same array
+        key = (name, shape, np.dtype(dtype))
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = np.zeros(shape, dtype=dtype)
+            self.buffers[key] = buf
+        return buf
+
+    @property
+    def nbytes(self) -> int:
+        buffers = [self.padded, self.mask, self.oxygen, self.fuel, self.heat, *self.cell_state, self.oxygen_higher_count, *self.buffers.values()]
+        return sum(buf.nbytes for buf in buffers if buf is not None)
+
 
 class Neighborhood:
-    def __init__(self, config: Configuration):
+    # fields a neighborhood can calculate, the state counts are named after their state
+    STATE_FIELDS = {
+        State.FIRE: 'fire',
+        State.INCOMBUSTIBLE: 'incombustible',
+        State.HOT: 'hot',
+        State.VEGETATION: 'vegetation',
+    }
+    FIELDS = frozenset(['oxygen', 'fuel', 'heat', 'oxygen_higher_count', *STATE_FIELDS.values()])
+    # largest value of heat, fuel and oxygen
+    MAX_VALUE = 5
+    # whether the diagonal cells are neighbors
+    DIAGONAL = False
+
+    def __init__(self, config: Configuration, workspace: NeighborhoodWorkspace = None):
         self.config = config
+        self.workspace = workspace if workspace is not None else NeighborhoodWorkspace(config)
+        self.radius = self.workspace.radius
+        self.boundary = Boundary(config, self.radius)
 
-    def calculate(self, state: State):
+    def calculate(self, state: State, tiles: list = None):
+        # Only the cells of the given tiles (tuples of slices) are calculated, default is the full grid.
         pass
 
+    def arrange(self, state: State) -> None:
+        # store the state in the configured layout
+        if self.config.layout == 'ghost':
+            state.pad(self.radius)
+        elif self.config.layout != 'plain':
+            logging.getLogger(type(self).__name__).error(f"Invalid layout {self.config.layout} -> fallback to plain")
+
+    def refresh(self, state: State) -> None:
+        # ghost cells of a padded state are filled once per calculation
+        if state.ghost('cell_state', self.radius) is None:
+            return
+        for name, padded in state.padded.items():
+            self.boundary.fill(padded, getattr(state, name))
+
+    def source(self, state: State, name: str, tile, value=None, compare=np.equal) -> np.ndarray:
+        """
+        Padded array holding the attribute (or whether it compares to a value) for the tile and its halo.
+        The ghost cells of a padded state are read directly, otherwise the attribute is copied.
+        """
+        padded = self.workspace.padded
+        ghost = state.ghost(name, self.radius)
+        if ghost is not None:
+            if value is None:
+                return ghost
+            sx, sy = tile
+            halo = (slice(sx.start, sx.stop + 2*self.radius), slice(sy.start, sy.stop + 2*self.radius))
+            compare(ghost[..., *halo], value, out=padded[..., *halo])
+            return padded
+        values = getattr(state, name)
+        self.fill(padded, values, tile, value, compare, self.radius)
+        self.boundary.fill(padded, values, tile, value, compare)
+        return padded
+
+    @staticmethod
+    def fill(padded, values, tile, value=None, compare=np.equal, radius=1):
+        # copy the values of the tile and its halo into the padded buffer
+        # or whether they compare to a value (default: equal), if given
+        sx, sy = tile
+        r = radius
+        x0, x1 = max(sx.start - r, 0), min(sx.stop + r, values.shape[-2])
+        y0, y1 = max(sy.start - r, 0), min(sy.stop + r, values.shape[-1])
+        if value is None:
+            np.copyto(padded[..., x0+r:x1+r, y0+r:y1+r], values[..., x0:x1, y0:y1])
+        else:
+            compare(values[..., x0:x1, y0:y1], value, out=padded[..., x0+r:x1+r, y0+r:y1+r])
+
 
 class NeumannNeighborhood(Neighborhood):
-    def calculate(self, state):
-        width = self.config.width
-        height = self.config.height
-        
-        # oxygen neighborhood
-        nbs_ox = np.zeros((width+2, height+2))
-        #nbs_ox[1:-1,1:-1]+=oxygen #middle
-        nbs_ox[1:-1,:-2]+=state.oxygen #left
-        nbs_ox[1:-1,2:]+=state.oxygen #right
-        nbs_ox[:-2,1:-1]+=state.oxygen #up
-        nbs_ox[2:,1:-1]+=state.oxygen #down
-
-        # fuel neighborhood
-        nbs_fuel = np.zeros((width+2, height+2))
-        #nbs_fuel[1:-1,1:-1]+=fuel #middle
-        nbs_fuel[1:-1,:-2]+=state.fuel #left
-        nbs_fuel[1:-1,2:]+=state.fuel #right
-        nbs_fuel[:-2,1:-1]+=state.fuel #up
-        nbs_fuel[2:,1:-1]+=state.fuel #down
+    def calculate(self, state, tiles=None):
+        ws = self.workspace
+        fields = ws.fields
+        if tiles is None:
+            tiles = [(slice(0, self.config.width), slice(0, self.config.height))]
+        self.refresh(state)
         
-        # heat neighborhood
-        nbs_heat = np.zeros((width+2, height+2))
-        #nbs_heat[1:-1,1:-1]+=heat #middle
-        nbs_heat[1:-1,:-2]+=state.heat #left
-        nbs_heat[1:-1,2:]+=state.heat #right
-        nbs_heat[:-2,1:-1]+=state.heat #up
-        nbs_heat[2:,1:-1]+=state.heat #down
-
-        # count neighbors that have a higher oxygen value than the center cell
-        padded_ox = np.zeros((width+2, height+2))
-        padded_ox[1:-1,1:-1] = state.oxygen
-        left_higher = padded_ox[1:-1,:-2] > state.oxygen
-        right_higher = padded_ox[1:-1,2:] > state.oxygen
-        up_higher = padded_ox[:-2,1:-1] > state.oxygen
-        down_higher = padded_ox[2:,1:-1] > state.oxygen
-        nbs_ox_higher_count = (left_higher.astype(int) + right_higher.astype(int) + up_higher.astype(int) + down_higher.astype(int))
-        
-        # state neighborhood (is array with numbers of all 4 states)
-        nbs_state = []
-        for i in range(State.STATESCOUNT):
-            state_i = (state.cell_state == i)
-            nbs_state_i = np.zeros((width+2, height+2))
-            #nbs_state_i[1:-1,1:-1]+=state_i #middle
-            nbs_state_i[1:-1,:-2]+=state_i #left
-            nbs_state_i[1:-1,2:]+=state_i #right
-            nbs_state_i[:-2,1:-1]+=state_i #up
-            nbs_state_i[2:,1:-1]+=state_i #down
-            nbs_state.insert(i,nbs_state_i[1:-1,1:-1])
-
-        res = State(nbs_ox[1:-1,1:-1], nbs_fuel[1:-1,1:-1], nbs_heat[1:-1,1:-1], nbs_state)
-        # attach helper information to the returned neighborhood State
-        res.oxygen_higher_count = nbs_ox_higher_count
+        for tile in tiles:
+            if 'oxygen' in fields or 'oxygen_higher_count' in fields:
+                padded = self.source(state, 'oxygen', tile)
+
+            # oxygen neighborhood
+            if 'oxygen' in fields:
+                self.sum_neighbors(padded, ws.oxygen[..., *tile], tile)
+
+            # count neighbors that have a higher oxygen value than the center cell
+            if 'oxygen_higher_count' in fields:
+                center = state.oxygen[..., *tile]
+                count = ws.oxygen_higher_count[..., *tile]
+                mask = ws.mask[..., *tile]
+                left, right, up, down = self.shifted(padded, tile)
+                np.greater(left, center, out=count)
+                for shifted in (right, up, down):
+                    np.greater(shifted, center, out=mask)
+                    np.add(count, mask, out=count)
+
+            # fuel neighborhood
+            if 'fuel' in fields:
+                padded = self.source(state, 'fuel', tile)
+                self.sum_neighbors(padded, ws.fuel[..., *tile], tile)
+            
+            # heat neighborhood
+            if 'heat' in fields:
+                padded = self.source(state, 'heat', tile)
+                self.sum_neighbors(padded, ws.heat[..., *tile], tile)
+            
+            # state neighborhood (numbers of neighbors in each of the 4 states)
+            for i, name in self.STATE_FIELDS.items():
+                if name in fields:
+                    padded = self.source(state, 'cell_state', tile, i)
+                    self.sum_neighbors(padded, ws.cell_state[i][..., *tile], tile)
+
+        return ws.result
+
+    @staticmethod
+    def shifted(padded, tile):
+        # left, right, up and down neighbors of the tile in the padded buffer
+        sx, sy = tile
+        inner_x = slice(sx.start+1, sx.stop+1)
+        inner_y = slice(sy.start+1, sy.stop+1)
+        return (
+            padded[..., inner_x, sy.start:sy.stop],
+            padded[..., inner_x, sy.start+2:sy.stop+2],
+            padded[..., sx.start:sx.stop, inner_y],
+            padded[..., sx.start+2:sx.stop+2, inner_y],
+        )
+
+    @classmethod
+    def sum_neighbors(cls, padded, out, tile):
+        # sum of the four neighbors of every cell of the tile
+        left, right, up, down = cls.shifted(padded, tile)
+        np.add(left, right, out=out)
+        np.add(out, up, out=out)
+        np.add(out, down, out=out)
+
+
+class MooreNeighborhood(Neighborhood):
+    """
+    All cells of the (2r+1)x(2r+1) square around a cell, except the cell itself.
+
+    The sums are box filters computed separably from running sums along
+    each axis, so the cost per cell does not depend on the radius. The
+    neighbors with a higher oxygen value are counted with one box filter
+    per oxygen level instead of comparing every neighbor to the center.
+    """
+
+    DIAGONAL = True
+
+    def __init__(self, config: Configuration, workspace: NeighborhoodWorkspace = None):
+        super().__init__(config, workspace)
+        ws = self.workspace
+        r = self.radius
+        batch = ws.padded.shape[:-2]
+        count = ws.padded.dtype
+        # The running sums wrap around in an unsigned dtype. Differences of them are
+        # still exact as long as the sums of the (2r+1)x(2r+1) squares fit into it.
+        table = np.min_scalar_type((2*r + 1)**2 * self.MAX_VALUE)
+        # running sums along x with a leading zero row, then along y with a leading zero column
+        self.table_x = ws.buffer("table_x", (*batch, config.width + 2*r + 1, config.height + 2*r), table)
+        self.table_y = ws.buffer("table_y", (*batch, config.width, config.height + 2*r + 1), table)
+        self.level = ws.buffer("level", (*batch, config.width, config.height), count) if 'oxygen_higher_count' in ws.fields else None
+
+    @classmethod
+    def get_radius(cls, config: Configuration) -> int:
+        logger = logging.getLogger("MooreNeighborhood")
+        radius = config.radius
+        if radius < 1:
+            logger.error(f"Invalid radius {radius} -> fallback to 1")
+            radius = 1
+        count = np.dtype(State.get_dtypes(config.dtype)['count'])
+        if count.kind != 'f':
+            # the sums of all neighbors have to fit into the count dtype
+            largest = int((np.sqrt(np.iinfo(count).max / cls.MAX_VALUE + 1) - 1) // 2)
+            if radius > largest:
+                logger.error(f"Radius {radius} overflows the {count} neighbor sums -> fallback to {largest}")
+                radius = largest
+        return radius
+
+    def calculate(self, state, tiles=None):
+        ws = self.workspace
+        fields = ws.fields
+        if tiles is None:
+            tiles = [(slice(0, self.config.width), slice(0, self.config.height))]
+        self.refresh(state)
+
+        for tile in tiles:
+            # oxygen neighborhood
+            if 'oxygen' in fields:
+                padded = self.source(state, 'oxygen', tile)
+                self.sum_neighbors(padded, ws.oxygen[..., *tile], tile)
+
+            # count neighbors that have a higher oxygen value than the center cell,
+            # they are the neighbors above the level of the center
+            if 'oxygen_higher_count' in fields:
+                center = state.oxygen[..., *tile]
+                count = ws.oxygen_higher_count[..., *tile]
+                mask = ws.mask[..., *tile]
+                level = self.level[..., *tile]
+                count.fill(0)
+                for value in range(self.MAX_VALUE):
+                    padded = self.source(state, 'oxygen', tile, value, np.greater)
+                    self.sum_neighbors(padded, level, tile)
+                    # the centers of a level do not overlap, so their counts are added up
+                    np.equal(center, value, out=mask)
+                    np.multiply(level, mask, out=level)
+                    np.add(count, level, out=count)
+
+            # fuel neighborhood
+            if 'fuel' in fields:
+                padded = self.source(state, 'fuel', tile)
+                self.sum_neighbors(padded, ws.fuel[..., *tile], tile)
+
+            # heat neighborhood
+            if 'heat' in fields:
+                padded = self.source(state, 'heat', tile)
+                self.sum_neighbors(padded, ws.heat[..., *tile], tile)
+
+            # state neighborhood (numbers of neighbors in each of the 4 states)
+            for i, name in self.STATE_FIELDS.items():
+                if name in fields:
+                    padded = self.source(state, 'cell_state', tile, i)
+                    self.sum_neighbors(padded, ws.cell_state[i][..., *tile], tile)
+
+        return ws.result
+
+    def sum_neighbors(self, padded, out, tile):
+        # box sum of the square around every cell of the tile without the cell itself
+        sx, sy = tile
+        r = self.radius
+        n = 2*r + 1
+        width = sx.stop - sx.start
+        height = sy.stop - sy.start
+        region = padded[..., sx.start:sx.stop + 2*r, sy.start:sy.stop + 2*r]
+
+        # sums of n rows
+        table_x = self.table_x[..., :width + 2*r + 1, :height + 2*r]
+        np.cumsum(region, axis=-2, dtype=table_x.dtype, out=table_x[..., 1:, :])
+        table_y = self.table_y[..., :width, :height + 2*r + 1]
+        np.subtract(table_x[..., n:, :], table_x[..., :width, :], out=table_y[..., 1:])
 
-        return res
\ No newline at end of file
+        # sums of n columns of these
+        np.cumsum(table_y[..., 1:], axis=-1, dtype=table_y.dtype, out=table_y[..., 1:])
+        np.subtract(table_y[..., n:], table_y[..., :height], out=out, casting='unsafe')
+        np.subtract(out, region[..., r:r + width, r:r + height], out=out)
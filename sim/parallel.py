@@ -0,0 +1,204 @@
+import copy
+import logging
+import multiprocessing
+import numpy as np
+import os
+from config import Configuration
+from multiprocessing import shared_memory
+
+from .engine import Engine, FusedKernel
+from .neighborhood import Neighborhood, NeighborhoodGenerator, NeighborhoodWorkspace
+from .state import State
+
+logger = logging.getLogger("ParallelEngine")
+
+ATTRIBUTES = ('heat', 'fuel', 'oxygen', 'cell_state', 'time_since_burnt_out')
+
+
+def attach(spec: tuple) -> tuple:
+    # (name, shape, dtype) of a shared memory block -> (block, array onto it)
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name, track=False)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def run_worker(config: Configuration, x0: int, x1: int, state_specs: dict, sample_specs: dict, barrier, stop) -> None:
+    """
+    Simulate the rows x0..x1 of the grid in place in shared memory.
+
+    Every step the worker calculates the neighborhood of its strip,
+    reading the halo rows of its neighbors straight from shared memory.
+    Once all workers are done reading, each one applies the rules to its
+    own strip in place, so no rows are copied at all.
+    """
+    from .rule import RuleGenerator
+
+    blocks = []
+    try:
+        shared = {}
+        for attr, spec in state_specs.items():
+            shm, shared[attr] = attach(spec)
+            blocks.append(shm)
+
+        rules = RuleGenerator.get(config)
+        for i, specs in sample_specs.items():
+            samples = []
+            for spec in specs:
+                shm, arr = attach(spec)
+                blocks.append(shm)
+                samples.append(arr)
+            # the random samples are drawn by the main process for the whole grid
+            rules[i].samples = samples
+        kernel = FusedKernel(rules)
+
+        # strip with halo rows of the neighborhood radius on each side, as far as the grid reaches
+        radius = NeighborhoodGenerator.radius(config)
+        h0 = max(x0 - radius, 0)
+        h1 = min(x1 + radius, config.width)
+        local_config = copy.copy(config)
+        local_config.width = h1 - h0
+        fields = RuleGenerator.neighborhood_fields(rules)
+        neighborhood = NeighborhoodGenerator.get(local_config, NeighborhoodWorkspace(local_config, fields))
+
+        # the strip and its halo rows in shared memory
+        local = {attr: shared[attr][h0:h1] for attr in ATTRIBUTES}
+        local_state = State(local['heat'], local['fuel'], local['oxygen'], local['cell_state'])
+        local_state.time_since_burnt_out = local['time_since_burnt_out']
+        inner = (slice(x0 - h0, x1 - h0), slice(0, config.height))
+        strip = (slice(x0, x1), slice(0, config.height))
+
+        while True:
+            barrier.wait()
+            if stop.value:
+                break
+
+            # the halo rows were written by the neighbors in the last step
+            local_state.invalidate()
+            nbs = neighborhood.calculate(local_state, [inner])
+            # all halo rows are read before any strip is written
+            barrier.wait()
+
+            view = local_state.view(inner)
+            # random samples are indexed in grid coordinates
+            view.index = strip
+            targets = [getattr(view, attr) for attr in ATTRIBUTES]
+            res = kernel.calculate(view, nbs.view(inner))
+            for attr, target in zip(ATTRIBUTES, targets):
+                new = getattr(res, attr)
+                if new is not target:
+                    # rules without an in-place variant allocate new arrays
+                    np.copyto(target, new)
+            barrier.wait()
+    except Exception:
+        logger.exception(f"Worker for rows {x0}..{x1} failed")
+        barrier.abort()
+    finally:
+        for shm in blocks:
+            shm.close()
+
+
+class ParallelEngine(Engine):
+    """
+    Split the grid into strips of rows simulated by a pool of worker processes.
+
+    The state and the random samples of a step live in shared memory.
+    The workers read the halo rows of their neighbors from it and update
+    their strips in place, so the results are the same as the serial
+    engines.
+    """
+
+    def __init__(self, config: Configuration, neighborhood: Neighborhood, rules: list):
+        super().__init__(config, neighborhood, rules)
+        workers = config.workers if config.workers > 0 else os.cpu_count()
+        self.workers = max(1, min(workers, config.width))
+        self.blocks = []
+        self.processes = []
+        self.samples = {}
+        self.state = None
+
+    def share(self, arr: np.ndarray) -> tuple:
+        # copy an array into a new shared memory block
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        self.blocks.append(shm)
+        shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        np.copyto(shared, arr)
+        return shared, (shm.name, arr.shape, arr.dtype.str)
+
+    def start(self, state: State) -> None:
+        # move the state into shared memory, the state object stays the same
+        # the workers pad their strips themselves, so a ghost cell layout is dropped
+        state.unpad()
+        state_specs = {}
+        for attr in ATTRIBUTES:
+            shared, state_specs[attr] = self.share(getattr(state, attr))
+            setattr(state, attr, shared)
+        self.state = state
+
+        sample_specs = {}
+        for i, rule in enumerate(self.rules):
+            rule.begin_step(state)
+            samples = getattr(rule, 'samples', None)
+            if samples is not None:
+                self.samples[i] = []
+                sample_specs[i] = []
+                for sample in samples:
+                    shared, spec = self.share(sample)
+                    self.samples[i].append(shared)
+                    sample_specs[i].append(spec)
+
+        ctx = multiprocessing.get_context()
+        self.barrier = ctx.Barrier(self.workers + 1)
+        self.stop = ctx.Value('b', 0)
+        bounds = np.linspace(0, self.config.width, self.workers + 1).astype(int)
+        for x0, x1 in zip(bounds[:-1], bounds[1:]):
+            process = ctx.Process(
+                target=run_worker,
+                args=(self.config, int(x0), int(x1), state_specs, sample_specs, self.barrier, self.stop),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self.logger.debug(f"Started {self.workers} workers")
+
+    def step(self, state: State) -> State:
+        if self.state is None:
+            # the samples of the first step are drawn by start
+            self.start(state)
+        else:
+            for rule in self.rules:
+                rule.begin_step(state)
+            for i, shared in self.samples.items():
+                for buf, sample in zip(shared, self.rules[i].samples):
+                    np.copyto(buf, sample)
+        for rule in self.rules:
+            rule.end_step()
+
+        self.barrier.wait() # start
+        self.barrier.wait() # neighborhoods calculated
+        self.barrier.wait() # strips written
+        state.invalidate()
+        return state
+
+    def close(self) -> None:
+        if self.state is None:
+            return
+        self.stop.value = 1
+        try:
+            self.barrier.wait(timeout=10)
+        except Exception:
+            pass
+        for process in self.processes:
+            process.join(timeout=10)
+
+        # move the state back out of shared memory
+        for attr in ATTRIBUTES:
+            setattr(self.state, attr, getattr(self.state, attr).copy())
+        for rule in self.rules:
+            rule.end_step()
+        self.samples = {}
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+        self.processes = []
+        self.state = None
@@ -1,7 +1,11 @@
 import logging
 import numpy as np
+import struct
+import zipfile
 from abc import ABC, abstractmethod
 from config import Configuration
+from pathlib import Path
+from PIL import Image
 
 from .state import State
 
@@ -19,6 +23,13 @@ class PresetGenerator:
         elif config.preset_source == "spark":
             preset = SparkPreset(config)
             logger.debug("SparkPreset chosen")
+        elif config.preset_source == "file":
+            if config.preset_file and Path(config.preset_file).is_file():
+                preset = FilePreset(config)
+                logger.debug("FilePreset chosen")
+            else:
+                preset = RandomPreset(config)
+                logger.error(f"Preset file {config.preset_file} not found -> fallback to RandomPreset")
         else:
             preset = RandomPreset(config)
             logger.error("No or invalid preset given -> fallback to RandomPreset")
@@ -36,41 +47,49 @@ class Preset(ABC):
 
 class RandomPreset(Preset):
     FIRE_PROBABILITY = 0.05
+    # Rows drawn at once, keeps the temporaries of the random draws small.
+    # Drawing in chunks yields the same random streams as drawing all at once.
+    CHUNK_ROWS = 1024
 
     def generate(self):
         size = (self.config.width, self.config.height)
         rng = np.random.default_rng(self.config.seed)
+        dtypes = State.get_dtypes(self.config.dtype)
 
-        veg_state = np.full(size, State.VEGETATION)
-        veg_oxygen = np.full(size, 4)
-        veg_fuel = rng.integers(0, 6, size=size)
-        veg_heat = np.zeros(size)
+        # int32 draws the same stream as the default int64
+        fuel = np.empty(size, dtype=dtypes['fuel'])
+        for i in range(0, size[0], self.CHUNK_ROWS):
+            chunk = fuel[i:i + self.CHUNK_ROWS]
+            chunk[...] = rng.integers(0, 6, size=chunk.shape, dtype=np.int32)
 
-        fire_state = np.full(size, State.FIRE)
-        fire_oxygen = np.full(size, 4)
-        fire_fuel = np.full(size, 4)
-        fire_heat = np.full(size, 4)
+        fire = np.empty(size, dtype=bool)
+        for i in range(0, size[0], self.CHUNK_ROWS):
+            chunk = fire[i:i + self.CHUNK_ROWS]
+            chunk[...] = rng.uniform(size=chunk.shape) < self.FIRE_PROBABILITY
 
-        mask = rng.uniform(size=size)
-        state = np.where(mask < self.FIRE_PROBABILITY, fire_state, veg_state)
-        oxygen = np.where(mask < self.FIRE_PROBABILITY, fire_oxygen, veg_oxygen)
-        fuel = np.where(mask < self.FIRE_PROBABILITY, fire_fuel, veg_fuel)
-        heat = np.where(mask < self.FIRE_PROBABILITY, fire_heat, veg_heat)
+        state = np.full(size, State.VEGETATION, dtype=dtypes['cell_state'])
+        oxygen = np.full(size, 4, dtype=dtypes['oxygen'])
+        heat = np.zeros(size, dtype=dtypes['heat'])
 
-        return State(heat, fuel, oxygen, state)
+        state[fire] = State.FIRE
+        fuel[fire] = 4
+        heat[fire] = 4
+
+        return State(heat, fuel, oxygen, state, dtypes)
 
 
 class FireWallPreset(Preset):
     def generate(self):
         random = RandomPreset(self.config).generate()
         size = (self.config.width, self.config.height)
+        dtypes = State.get_dtypes(self.config.dtype)
 
-        state = np.full(size, State.VEGETATION)
+        state = np.full(size, State.VEGETATION, dtype=dtypes['cell_state'])
         #oxygen = (random.oxygen % 3) + 1
         #fuel = (random.fuel % 3) + 1
         oxygen = random.oxygen
         fuel = random.fuel
-        heat = np.zeros(size)
+        heat = np.zeros(size, dtype=dtypes['heat'])
 
         state[:, 0] = State.FIRE
         state[:, -1] = State.FIRE
@@ -81,22 +100,162 @@ class FireWallPreset(Preset):
         heat[:, 0] = 4
         heat[:, -1] = 4
 
-        return State(heat, fuel, oxygen, state)
+        return State(heat, fuel, oxygen, state, dtypes)
     
 
 class SparkPreset(Preset):
     def generate(self):
         random = RandomPreset(self.config).generate()
         size = (self.config.width, self.config.height)
+        dtypes = State.get_dtypes(self.config.dtype)
 
-        state = np.full(size, State.VEGETATION)
+        state = np.full(size, State.VEGETATION, dtype=dtypes['cell_state'])
         oxygen = random.oxygen
         fuel = (random.fuel % 3)
-        heat = np.zeros(size)
+        heat = np.zeros(size, dtype=dtypes['heat'])
 
         state[(self.config.width//2),(self.config.height//2)] = State.FIRE
         oxygen[(self.config.width//2),(self.config.height//2)] = 4
         fuel[(self.config.width//2),(self.config.height//2)] = 4
         heat[(self.config.width//2),(self.config.height//2)] = 4
 
-        return State(heat, fuel, oxygen, state)
\ No newline at end of file
+        return State(heat, fuel, oxygen, state, dtypes)
+
+
+class FilePreset(Preset):
+    """
+    Initial condition loaded from a file, the grid size is taken from it.
+
+    .npy files and the uncompressed members of .npz files are memory mapped
+    copy-on-write, so only the pages the simulation touches are read and
+    changes never reach the file. Palette and grayscale images only hold
+    the cell states. Attributes missing in the file are filled in like the
+    other presets do. The value ranges are checked in chunks of rows.
+    """
+
+    # order of the attributes in a stacked .npy file
+    ATTRIBUTES = ('heat', 'fuel', 'oxygen', 'cell_state')
+    # largest value of each attribute, the fuel is only limited by its dtype
+    LIMITS = {'heat': 5, 'oxygen': 5, 'cell_state': State.STATESCOUNT - 1}
+    # value of the attributes missing in the file, fire cells get FIRE_HEAT
+    FILL = {'heat': 0, 'fuel': 4, 'oxygen': 4}
+    FIRE_HEAT = 4
+    IMAGE_MODES = ('P', 'L')
+    CHUNK_ROWS = RandomPreset.CHUNK_ROWS
+
+    def __init__(self, config: Configuration):
+        super().__init__(config)
+        self.logger = logging.getLogger("FilePreset")
+        self.path = Path(config.preset_file)
+
+        width, height = self.shape()
+        if (width, height) != (config.width, config.height):
+            self.logger.info(f"Grid size {width}x{height} taken from {self.path}")
+        config.width = width
+        config.height = height
+
+    def shape(self) -> tuple:
+        if self.path.suffix not in (".npy", ".npz"):
+            # only reads the header of the image
+            with Image.open(self.path) as img:
+                return img.height, img.width
+        return next(iter(self.load().values())).shape
+
+    def load(self) -> dict:
+        # attribute -> array of the file, a new mapping on every call
+        if self.path.suffix == ".npy":
+            data = np.load(self.path, mmap_mode='c', allow_pickle=False)
+            if data.ndim == 3 and len(data) == len(self.ATTRIBUTES):
+                arrays = dict(zip(self.ATTRIBUTES, data))
+            elif data.ndim == 2:
+                arrays = {'cell_state': data}
+            else:
+                raise ValueError(f"{self.path} has shape {data.shape}, expected (width, height) or ({len(self.ATTRIBUTES)}, width, height)")
+        elif self.path.suffix == ".npz":
+            arrays = self.load_npz()
+        else:
+            arrays = {'cell_state': self.load_image()}
+
+        if 'cell_state' not in arrays:
+            raise ValueError(f"{self.path} contains no cell_state")
+        shape = arrays['cell_state'].shape
+        for name, values in arrays.items():
+            if values.ndim != 2 or values.shape != shape:
+                raise ValueError(f"{name} of {self.path} has shape {values.shape}, expected {shape}")
+            if values.dtype.kind not in 'biuf':
+                raise ValueError(f"{name} of {self.path} has dtype {values.dtype}, expected numbers")
+        # plain arrays, memory maps stay memory maps under numpy operations otherwise
+        return {name: np.asarray(values) for name, values in arrays.items()}
+
+    def load_npz(self) -> dict:
+        arrays = {}
+        with zipfile.ZipFile(self.path) as archive, open(self.path, "rb") as f:
+            for info in archive.infolist():
+                name = info.filename.removesuffix(".npy")
+                # checkpoints store the state with a prefix
+                name = name.removeprefix("state.")
+                if name not in self.ATTRIBUTES:
+                    continue
+                values = self.map_member(archive, info, f)
+                if values is None:
+                    self.logger.debug(f"{info.filename} of {self.path} is compressed -> loaded into memory")
+                    with archive.open(info) as member:
+                        values = np.lib.format.read_array(member, allow_pickle=False)
+                arrays[name] = values
+        return arrays
+
+    def map_member(self, archive: zipfile.ZipFile, info: zipfile.ZipInfo, f):
+        # memory map of an uncompressed .npy member, None if it can not be mapped
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+        with archive.open(info) as member:
+            version = np.lib.format.read_magic(member)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+            else:
+                return None
+            header = member.tell()
+        if dtype.hasobject:
+            return None
+        # the data starts after the local file header of the member and the .npy header
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+        offset = info.header_offset + 30 + name_length + extra_length + header
+        return np.memmap(self.path, dtype=dtype, mode='c', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+    def load_image(self) -> np.ndarray:
+        with Image.open(self.path) as img:
+            if img.mode not in self.IMAGE_MODES:
+                raise ValueError(f"{self.path} is a {img.mode} image, expected a palette or grayscale image of cell states")
+            # palette indices, not the colors, copied since the state is changed in place
+            return np.array(img)
+
+    def validate(self, name: str, values: np.ndarray, limit: int) -> None:
+        for i in range(0, values.shape[0], self.CHUNK_ROWS):
+            chunk = values[i:i + self.CHUNK_ROWS]
+            low, high = chunk.min(), chunk.max()
+            if low < 0 or high > limit:
+                raise ValueError(f"{name} of {self.path} has values in [{low}, {high}] in rows {i} to {i + len(chunk) - 1}, expected [0, {limit}]")
+
+    def generate(self):
+        arrays = self.load()
+        dtypes = State.get_dtypes(self.config.dtype)
+        if self.config.preset_validate:
+            for name, values in arrays.items():
+                limit = self.LIMITS.get(name, np.iinfo(dtypes[name]).max if np.issubdtype(dtypes[name], np.integer) else np.inf)
+                self.validate(name, values, limit)
+
+        state = arrays['cell_state']
+        size = state.shape
+        missing = [name for name in self.FILL if name not in arrays]
+        for name in missing:
+            arrays[name] = np.full(size, self.FILL[name], dtype=dtypes[name])
+        if 'heat' in missing:
+            heat = arrays['heat']
+            for i in range(0, size[0], self.CHUNK_ROWS):
+                heat[i:i + self.CHUNK_ROWS][state[i:i + self.CHUNK_ROWS] == State.FIRE] = self.FIRE_HEAT
+
+        self.logger.debug(f"Loaded {self.path}, filled in {missing}")
+        return State(arrays['heat'], arrays['fuel'], arrays['oxygen'], state, dtypes)
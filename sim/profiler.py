@@ -0,0 +1,116 @@
+import csv
+import logging
+import numpy as np
+import time
+from pathlib import Path
+
+
+class Profiler:
+    """
+    Wall time per step of the phases of a simulation.
+
+    The phases are timed by wrapping the methods of the objects taking
+    part in a step, so nothing is measured or slowed down unless a
+    profiler was attached. Phases called several times in a step, e.g.
+    the rules of the ActiveTileEngine per tile, are summed up. Besides the
+    times, values describing a step are recorded as metrics, e.g. the
+    fraction of the tiles the ActiveTileEngine ran.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Profiler")
+        # phase -> time of the current row
+        self.current = {}
+        # (label, {phase: time}) per step and one row for the finish calls
+        self.rows = []
+        self.phases = []
+        self.metrics = []
+
+    def instrument(self, obj, method: str, phase: str) -> None:
+        # replace the method of this instance by a timed one
+        original = getattr(obj, method)
+        if phase not in self.phases:
+            self.phases.append(phase)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.current[phase] = self.current.get(phase, 0.0) + time.perf_counter() - start
+
+        setattr(obj, method, timed)
+
+    def observe(self, obj, method: str, metric: str, value) -> None:
+        # record value() after every call of the method of this instance
+        original = getattr(obj, method)
+        if metric not in self.metrics:
+            self.metrics.append(metric)
+
+        def observed(*args, **kwargs):
+            result = original(*args, **kwargs)
+            self.current[metric] = value()
+            return result
+
+        setattr(obj, method, observed)
+
+    def attach(self, engine, neighborhood, rules: list, visualizers=None) -> None:
+        # imported here, the parallel module is only needed for the ParallelEngine
+        from .engine import ActiveTileEngine
+        from .parallel import ParallelEngine
+        self.instrument(engine, 'step', 'engine')
+        if isinstance(engine, ActiveTileEngine):
+            self.observe(engine, 'step', 'active_fraction', lambda: engine.active_fractions[-1])
+        if isinstance(engine, ParallelEngine):
+            # the neighborhood and the rules run inside the worker processes
+            self.logger.warning("The phases of the ParallelEngine workers are not profiled -> only the engine step is timed")
+        else:
+            self.instrument(neighborhood, 'calculate', 'neighborhood')
+            # the ActiveTileEngine wraps the engine applying the rules
+            inner = getattr(engine, 'engine', engine)
+            method = 'fused' if hasattr(inner, 'kernel') else 'calculate'
+            for rule in rules:
+                self.instrument(rule, method, f"rule/{type(rule).__name__}")
+        if visualizers is None:
+            return
+        # includes the statistics and the frames handed to the render pipeline
+        self.instrument(visualizers, 'visualize', 'visualize')
+        for vis in visualizers.visualizers:
+            name = type(vis).__name__
+            self.instrument(vis, 'visualize', f"visualize/{name}")
+            self.instrument(vis, 'finish', f"finish/{name}")
+
+    def end_step(self, label) -> None:
+        self.rows.append((label, self.current))
+        self.current = {}
+
+    def times(self, phase: str) -> np.ndarray:
+        # times (or values of a metric) of the rows the phase ran in
+        return np.array([row[phase] for _, row in self.rows if phase in row])
+
+    def summary(self) -> str:
+        lines = [f"{'phase':<48} {'steps':>6} {'total [s]':>11} {'mean [ms]':>11} {'p50 [ms]':>11} {'p99 [ms]':>11}"]
+        for phase in self.phases:
+            times = self.times(phase)
+            if len(times) == 0:
+                continue
+            p50, p99 = np.percentile(times, (50, 99)) * 1e3
+            lines.append(f"{phase:<48} {len(times):>6} {times.sum():>11.3f} {times.mean() * 1e3:>11.3f} {p50:>11.3f} {p99:>11.3f}")
+        if self.metrics:
+            lines.append(f"{'metric':<48} {'steps':>6} {'min':>11} {'mean':>11} {'p50':>11} {'max':>11}")
+        for metric in self.metrics:
+            values = self.times(metric)
+            if len(values) == 0:
+                continue
+            lines.append(f"{metric:<48} {len(values):>6} {values.min():>11.4f} {values.mean():>11.4f} {np.median(values):>11.4f} {values.max():>11.4f}")
+        return "\n".join(lines)
+
+    def save(self, path: Path) -> None:
+        # one row per step, times in seconds and then the metrics, empty if the phase did not run
+        columns = [*self.phases, *self.metrics]
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["step", *columns])
+            for label, row in self.rows:
+                writer.writerow([label, *(f"{row[column]:.9f}" if column in row else "" for column in columns)])
+        self.logger.info(f"Saved profile to {path}")
@@ -3,8 +3,10 @@ import numpy as np
 from abc import ABC, abstractmethod
 from config import Configuration
 
+from .checkpoint import pack_rng, unpack_rng
+from .engine import FusedKernel
 from .neighborhood import Neighborhood
-from .state import State
+from .state import State, saturating_add, saturating_sub
 
 class RuleGenerator:
     @classmethod
@@ -47,75 +49,165 @@ class RuleGenerator:
                 logger.error("Invalid rule: {rule}.")
         return rules
 
+    @classmethod
+    def neighborhood_fields(cls, rules: list) -> set:
+        # neighborhood fields read by any of the rules
+        return set().union(*(rule.NEIGHBORHOOD_FIELDS for rule in rules))
+
 
 class Rule(ABC):
+    # Neighborhood fields read by the rule (see Neighborhood.FIELDS).
+    # Rules that do not declare them get all fields.
+    NEIGHBORHOOD_FIELDS = Neighborhood.FIELDS
+
     @abstractmethod
     def calculate(self, state: State, nbs: Neighborhood) -> State:
         pass
 
+    def fused(self, state: State, nbs: Neighborhood, kernel: FusedKernel) -> State:
+        # In-place variant used by the FusedKernel; falls back to calculate.
+        state = self.calculate(state, nbs)
+        state.invalidate()
+        return state
+
+    def random_cells(self, state: State):
+        # Mask of cells whose update depends on random numbers, None if there are none.
+        return None
+
+    def begin_step(self, state: State) -> None:
+        # Called with the full grid before a step is applied tile by tile.
+        pass
+
+    def end_step(self) -> None:
+        pass
+
+    def checkpoint(self) -> dict:
+        # Arrays needed to resume the rule, e.g. the state of its random generators.
+        return {}
+
+    def restore(self, data: dict) -> None:
+        pass
+
 
 class DecreaseWhenFireRule(Rule):
+    NEIGHBORHOOD_FIELDS = set()
+
     def calculate(self, state: State, nbs: Neighborhood) -> State:
-        mask = (state.cell_state == State.FIRE)
-        
         # reduce oxygen, fuel, heat by 1 where the cell is on fire; clamp at 0
-        mask = (state.cell_state == State.FIRE)
-        state.oxygen = np.where(mask, np.maximum(state.oxygen - 1, 0), state.oxygen)
-        state.fuel = np.where(mask, np.maximum(state.fuel - 1, 0), state.fuel)
-        state.heat = np.where(mask, np.maximum(state.heat - 1, 0), state.heat)
+        mask = state.mask(State.FIRE)
+        state.oxygen = np.where(mask, saturating_sub(state.oxygen, 1), state.oxygen)
+        state.fuel = np.where(mask, saturating_sub(state.fuel, 1), state.fuel)
+        state.heat = np.where(mask, saturating_sub(state.heat, 1), state.heat)
         
         return state
+
+    def fused(self, state, nbs, kernel):
+        mask = kernel.state_mask(state, State.FIRE)
+        for attr in (state.oxygen, state.fuel, state.heat):
+            kernel.subtract(attr, mask)
+        return state
     
 
 class IncreaseHotForNeighborRule(Rule):
     # every state with hot in the neighborhood increases hot of the cell, max 5
+    NEIGHBORHOOD_FIELDS = {'hot'}
+
     def calculate(self, state, nbs):
-        state.heat = np.minimum(state.heat+nbs.cell_state[State.HOT],5)
+        state.heat = saturating_add(state.heat, nbs.cell_state[State.HOT], 5)
         
         return state
+
+    def fused(self, state, nbs, kernel):
+        # heat <= 5 and the neighbor counts leave room for it in the count dtype, so the sum cannot overflow
+        np.add(state.heat, nbs.cell_state[State.HOT], out=state.heat)
+        np.minimum(state.heat, 5, out=state.heat)
+        return state
     
 class IncreaseHeatExactlyOneFireRule(Rule):
     # increase heat by 2 if exactly one neighbor is on fire, max 5
+    NEIGHBORHOOD_FIELDS = {'fire'}
+
     def calculate(self, state, nbs):
         mask = (nbs.cell_state[State.FIRE] == 1)
-        state.heat = np.where(mask,np.minimum(state.heat + 2, 5), state.heat)
+        state.heat = np.where(mask,saturating_add(state.heat, 2, 5), state.heat)
+
+        return state
 
+    def fused(self, state, nbs, kernel):
+        mask = kernel.buffer("mask", state.heat.shape)
+        np.equal(nbs.cell_state[State.FIRE], 1, out=mask)
+        kernel.add(state.heat, mask, 2, 5)
         return state
 
 class IncreaseHeatMoreThanOneFireRule(Rule):
     # increase heat by 4 if more than one neighbor is on fire, max 5
+    NEIGHBORHOOD_FIELDS = {'fire'}
+
     def calculate(self, state, nbs):
         mask = (nbs.cell_state[State.FIRE] > 1)
-        state.heat = np.where(mask,np.minimum(state.heat + 4, 5), state.heat)
+        state.heat = np.where(mask,saturating_add(state.heat, 4, 5), state.heat)
 
         return state
 
+    def fused(self, state, nbs, kernel):
+        mask = kernel.buffer("mask", state.heat.shape)
+        np.greater(nbs.cell_state[State.FIRE], 1, out=mask)
+        kernel.add(state.heat, mask, 4, 5)
+        return state
+
 
 class IncreaseOxygenIfNeighborsHigherRule(Rule):
     # increase oxygen by 1 if 2 or more neighbors have higher oxygen level, max 5
+    NEIGHBORHOOD_FIELDS = {'oxygen_higher_count'}
+
     def calculate(self, state, nbs):
         # nbs.oxygen_higher_count contains number of neighbors with higher oxygen (0..4)
         mask = (nbs.oxygen_higher_count >= 2)
-        state.oxygen = np.where(mask, np.minimum(state.oxygen + 1, 5), state.oxygen)
+        state.oxygen = np.where(mask, saturating_add(state.oxygen, 1, 5), state.oxygen)
+        return state
+
+    def fused(self, state, nbs, kernel):
+        mask = kernel.buffer("mask", state.oxygen.shape)
+        np.greater_equal(nbs.oxygen_higher_count, 2, out=mask)
+        kernel.add(state.oxygen, mask, 1, 5)
         return state
 
 
 class VegetationToHotRule(Rule):
     # Vegetation with any heat becomes HOT
+    NEIGHBORHOOD_FIELDS = set()
+
     def calculate(self, state: State, nbs: Neighborhood) -> State:
-        mask = (state.cell_state == State.VEGETATION) & (state.heat > 0)
+        mask = state.mask(State.VEGETATION) & (state.heat > 0)
         state.cell_state = np.where(mask, State.HOT, state.cell_state)
         return state
+
+    def fused(self, state, nbs, kernel):
+        mask = kernel.buffer("mask", state.heat.shape)
+        np.greater(state.heat, 0, out=mask)
+        np.logical_and(mask, kernel.state_mask(state, State.VEGETATION), out=mask)
+        kernel.transition(state.cell_state, mask, State.VEGETATION, State.HOT)
+        state.invalidate('cell_state')
+        return state
     
 class DecreaseHeatInIncombustibleRule(Rule):
     # Decrease heat by 1 for INCOMBUSTIBLE cells each step, clamp at 0
+    NEIGHBORHOOD_FIELDS = set()
+
     def calculate(self, state: State, nbs: Neighborhood) -> State:
-        mask = (state.cell_state == State.INCOMBUSTIBLE)
-        state.heat = np.where(mask, np.maximum(state.heat - 1, 0), state.heat)
+        mask = state.mask(State.INCOMBUSTIBLE)
+        state.heat = np.where(mask, saturating_sub(state.heat, 1), state.heat)
+        return state
+
+    def fused(self, state, nbs, kernel):
+        mask = kernel.state_mask(state, State.INCOMBUSTIBLE)
+        kernel.subtract(state.heat, mask)
         return state
     
 class CellOnFireRule(Rule):
     # Decide ignition/extinguishing based on the configured approach.
+    NEIGHBORHOOD_FIELDS = set()
+
     def __init__(self, config: Configuration = None, threshold_sum: int = 8,
                  t_heat: int = 3, t_fuel: int = 1, t_oxygen: int = 1,
                  pb: float = 0.05, po: float = 0.10):
@@ -139,15 +231,63 @@ class CellOnFireRule(Rule):
             self.pb = getattr(config, 'pb', self.pb)
             self.po = getattr(config, 'po', self.po)
             seed = getattr(config, 'seed', None)
+            members = getattr(config, 'members', 0)
         else:
             seed = 123
+            members = 0
 
         # reproducible RNG when seed provided
         self.rng = np.random.RandomState(seed)
+        # ensembles draw every member from its own independent stream
+        self.member_rngs = None
+        if members > 0:
+            seeds = np.random.SeedSequence(seed).spawn(members)
+            self.member_rngs = [np.random.RandomState(np.random.MT19937(s)) for s in seeds]
+        # random samples of the whole grid while a step is applied tile by tile
+        self.samples = None
+
+    def draw(self, shape: tuple) -> np.ndarray:
+        if self.member_rngs is None:
+            return self.rng.random_sample(shape)
+        sample = np.empty(shape)
+        for rng, member in zip(self.member_rngs, sample):
+            member[...] = rng.random_sample(member.shape)
+        return sample
+
+    def random_sample(self, state: State, i: int):
+        # i-th random sample of the step for the cells of the state
+        if self.samples is not None:
+            return self.samples[i][state.index]
+        return self.draw(state.cell_state.shape)
+
+    def random_cells(self, state: State):
+        if self.approach == 'stochastic':
+            # HOT cells without fuel or oxygen can not ignite, whatever the samples are
+            ignitable = state.mask(State.HOT) & (state.fuel > 0) & (state.oxygen > 0)
+            return ignitable | state.mask(State.FIRE)
+        return None
+
+    def begin_step(self, state: State) -> None:
+        # draw the samples for the whole grid, so the random stream does not depend on the tiles
+        if self.approach == 'stochastic':
+            shape = state.cell_state.shape
+            self.samples = [self.draw(shape), self.draw(shape)]
+
+    def end_step(self) -> None:
+        self.samples = None
+
+    def checkpoint(self) -> dict:
+        rngs = [self.rng, *(self.member_rngs or [])]
+        return {f'rng{i}.{key}': value for i, rng in enumerate(rngs) for key, value in pack_rng(rng).items()}
+
+    def restore(self, data: dict) -> None:
+        rngs = [self.rng, *(self.member_rngs or [])]
+        for i, rng in enumerate(rngs):
+            unpack_rng(rng, {key: data[f'rng{i}.{key}'] for key in ('keys', 'pos', 'has_gauss', 'gauss')})
 
     def calculate(self, state: State, nbs: Neighborhood) -> State:
         # only HOT cells can ignite now
-        hot = (state.cell_state == State.HOT)
+        hot = state.mask(State.HOT)
         has_fuel_ox = (state.fuel > 0) & (state.oxygen > 0)
 
         if self.approach == 'general':
@@ -166,13 +306,13 @@ class CellOnFireRule(Rule):
 
         elif self.approach == 'stochastic':
             # ignition: HOT cell with fuel+oxygen can ignite with probability pb
-            rand = self.rng.random_sample(state.cell_state.shape)
+            rand = self.random_sample(state, 0)
             ignite = hot & has_fuel_ox & (rand < self.pb)
             state.cell_state = np.where(ignite, State.FIRE, state.cell_state)
 
             # extinction: burning cells can go out with probability po -> become HOT
-            rand2 = self.rng.random_sample(state.cell_state.shape)
-            burning = (state.cell_state == State.FIRE)
+            rand2 = self.random_sample(state, 1)
+            burning = state.mask(State.FIRE)
             extinguish = burning & (rand2 < self.po)
             state.cell_state = np.where(extinguish, State.INCOMBUSTIBLE, state.cell_state)
 
@@ -185,27 +325,82 @@ class CellOnFireRule(Rule):
         # Extinction rule for general and individual approaches: if any of
         # heat, oxygen or fuel is zero, a burning cell becomes INCOMBUSTIBLE
         unsustainable = (state.heat <= 0) | (state.oxygen <= 0) | (state.fuel <= 0)
-        burning_now = (state.cell_state == State.FIRE)
+        burning_now = state.mask(State.FIRE)
         to_incombustible = burning_now & unsustainable
         state.cell_state = np.where(to_incombustible, State.INCOMBUSTIBLE, state.cell_state)
 
         return state
 
+    def fused(self, state, nbs, kernel):
+        shape = state.cell_state.shape
+        ignite = kernel.buffer("ignite", shape)
+        tmp = kernel.buffer("tmp", shape)
+
+        # HOT cells with fuel and oxygen
+        np.greater(state.fuel, 0, out=ignite)
+        np.greater(state.oxygen, 0, out=tmp)
+        np.logical_and(ignite, tmp, out=ignite)
+        np.logical_and(ignite, kernel.state_mask(state, State.HOT), out=ignite)
+
+        if self.approach == 'individual':
+            np.greater_equal(state.heat, self.t_heat, out=tmp)
+            np.logical_and(ignite, tmp, out=ignite)
+            np.greater_equal(state.fuel, self.t_fuel, out=tmp)
+            np.logical_and(ignite, tmp, out=ignite)
+            np.greater_equal(state.oxygen, self.t_oxygen, out=tmp)
+            np.logical_and(ignite, tmp, out=ignite)
+            kernel.transition(state.cell_state, ignite, State.HOT, State.FIRE)
+
+        elif self.approach == 'stochastic':
+            # the RNG draws in the same order as calculate to keep the streams equal
+            np.less(self.random_sample(state, 0), self.pb, out=tmp)
+            np.logical_and(ignite, tmp, out=ignite)
+            kernel.transition(state.cell_state, ignite, State.HOT, State.FIRE)
+            state.invalidate('cell_state')
+
+            np.less(self.random_sample(state, 1), self.po, out=tmp)
+            np.logical_and(tmp, kernel.state_mask(state, State.FIRE), out=tmp)
+            kernel.transition(state.cell_state, tmp, State.FIRE, State.INCOMBUSTIBLE)
+
+        else:
+            # general and fallback
+            total = kernel.buffer("total", state.heat.shape, np.result_type(state.heat, state.fuel, state.oxygen))
+            np.add(state.heat, state.fuel, out=total)
+            np.add(total, state.oxygen, out=total)
+            np.greater_equal(total, self.threshold_sum, out=tmp)
+            np.logical_and(ignite, tmp, out=ignite)
+            kernel.transition(state.cell_state, ignite, State.HOT, State.FIRE)
+        state.invalidate('cell_state')
+
+        # burning cells without heat, oxygen or fuel become INCOMBUSTIBLE
+        np.less_equal(state.heat, 0, out=ignite)
+        np.less_equal(state.oxygen, 0, out=tmp)
+        np.logical_or(ignite, tmp, out=ignite)
+        np.less_equal(state.fuel, 0, out=tmp)
+        np.logical_or(ignite, tmp, out=ignite)
+        np.logical_and(ignite, kernel.state_mask(state, State.FIRE), out=ignite)
+        kernel.transition(state.cell_state, ignite, State.FIRE, State.INCOMBUSTIBLE)
+        state.invalidate('cell_state')
+
+        return state
+
 class RegenerateFromBurntOutRule(Rule):
     # Regenerate fuel in burnt-out cells over time.
+    NEIGHBORHOOD_FIELDS = {'fire'}
+
     def __init__(self, regen_rate=10):
         super().__init__()
         self.regen_rate = regen_rate  # Number of time steps for 1 fuel to regenerate
 
     def calculate(self, state: State, nbs: Neighborhood) -> State:
         # Identify burnt-out cells: INCOMBUSTIBLE with no fuel
-        burnt_out = (state.cell_state == State.INCOMBUSTIBLE)
+        burnt_out = state.mask(State.INCOMBUSTIBLE)
         
         # Check if any neighbors are on fire
         neighbors_on_fire = (nbs.cell_state[State.FIRE] > 0)
         
         # Increment time counter for burnt-out cells (only if they were already burnt out)
-        state.time_since_burnt_out = np.where(burnt_out, state.time_since_burnt_out + 1, 0)
+        state.time_since_burnt_out = np.where(burnt_out, saturating_add(state.time_since_burnt_out, 1), 0)
         
         # Regenerate fuel when: burnt out, enough time passed, and no neighbors on fire
         can_regenerate = (
@@ -215,20 +410,49 @@ class RegenerateFromBurntOutRule(Rule):
         )
         
         # Increase fuel by 1 and reset the timer
-        state.fuel = np.where(can_regenerate, state.fuel + 1, state.fuel)
+        state.fuel = np.where(can_regenerate, saturating_add(state.fuel, 1), state.fuel)
         state.time_since_burnt_out = np.where(can_regenerate, 0, state.time_since_burnt_out)
         
         return state
 
+    def fused(self, state, nbs, kernel):
+        burnt_out = kernel.state_mask(state, State.INCOMBUSTIBLE)
+        can_regenerate = kernel.buffer("mask", state.cell_state.shape)
+        timer = state.time_since_burnt_out
+
+        saturating_add(timer, 1, out=timer)
+        np.multiply(timer, burnt_out, out=timer)
+
+        np.equal(nbs.cell_state[State.FIRE], 0, out=can_regenerate)
+        np.logical_and(can_regenerate, burnt_out, out=can_regenerate)
+        tmp = kernel.buffer("tmp", state.cell_state.shape)
+        np.greater_equal(timer, self.regen_rate, out=tmp)
+        np.logical_and(can_regenerate, tmp, out=can_regenerate)
+
+        kernel.add(state.fuel, can_regenerate)
+        # the timers of the regenerated cells start again
+        np.logical_not(can_regenerate, out=can_regenerate)
+        np.multiply(timer, can_regenerate, out=timer)
+        return state
+
 
 class IncombustibleToVegetationRule(Rule):
     # Convert burnt-out cells back to vegetation when fuel has recovered.
+    NEIGHBORHOOD_FIELDS = set()
     
     def calculate(self, state: State, nbs: Neighborhood) -> State:
         # Cells that can recover: INCOMBUSTIBLE with fuel > 2
-        can_recover = (state.cell_state == State.INCOMBUSTIBLE) & (state.fuel > 2)
+        can_recover = state.mask(State.INCOMBUSTIBLE) & (state.fuel > 2)
         
         # Convert back to VEGETATION
         state.cell_state = np.where(can_recover, State.VEGETATION, state.cell_state)
         
         return state
+
+    def fused(self, state, nbs, kernel):
+        can_recover = kernel.buffer("mask", state.fuel.shape)
+        np.greater(state.fuel, 2, out=can_recover)
+        np.logical_and(can_recover, kernel.state_mask(state, State.INCOMBUSTIBLE), out=can_recover)
+        kernel.transition(state.cell_state, can_recover, State.INCOMBUSTIBLE, State.VEGETATION)
+        state.invalidate('cell_state')
+        return state
@@ -0,0 +1,301 @@
+import http.server
+import itertools
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+from config import Configuration
+from pathlib import Path
+
+from .simulation import Simulation
+from .sweep import Sweep, SweepWorker
+
+logger = logging.getLogger("SimulationService")
+
+# names of the cell states, indexed by the cell state
+STATE_NAMES = ('fire', 'incombustible', 'hot', 'vegetation')
+
+
+class SimulationService:
+    """
+    Runs simulations submitted over a local socket in a pool of warm workers.
+
+    Jobs are configurations with the sections and options of sim.ini,
+    posted as JSON to /jobs over HTTP on localhost or over a Unix socket.
+    They override the configuration the service was started with. The
+    worker processes are started once, so a job does not pay for the
+    interpreter startup and the imports. Jobs beyond the number of
+    workers wait in the task queue. Every job streams its events
+    back as JSON lines: queued, started, progress and a final summary
+    or error.
+    """
+
+    HOST = '127.0.0.1'
+
+    DEFAULT_CONFIG = {
+        'processes': 0,
+        'socket': '',
+        'port': 8765,
+        'progress': 10,
+    }
+
+    # seconds the workers get to stop before they are killed
+    STOP_TIMEOUT = 5
+    # seconds between the checks of the dispatcher whether the service is closed
+    DISPATCH_INTERVAL = 0.5
+
+    def __init__(self, config: Configuration, socket: str = None, port: int = None, processes: int = None):
+        self.config = config
+        processes = processes if processes is not None else config.getint('service', 'processes', fallback=self.DEFAULT_CONFIG['processes'])
+        self.processes = processes if processes > 0 else os.cpu_count()
+        self.socket = socket if socket is not None else config.get('service', 'socket', fallback=self.DEFAULT_CONFIG['socket'])
+        self.port = port if port is not None else config.getint('service', 'port', fallback=self.DEFAULT_CONFIG['port'])
+
+        # jobs waiting for a worker, and the events of all jobs sent by the workers,
+        # which are handed to the queue of their job
+        self.tasks = multiprocessing.Queue()
+        self.events = multiprocessing.Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+        self.workers = [multiprocessing.Process(target=work, args=(self.config, self.tasks, self.events), daemon=True) for _ in range(self.processes)]
+        for process in self.workers:
+            process.start()
+        self.stopped = threading.Event()
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+        self.server = None
+
+    def dispatch(self) -> None:
+        # only the workers write events, a worker killed while writing can not block the service
+        while not self.stopped.is_set():
+            try:
+                job, event = self.events.get(timeout=self.DISPATCH_INTERVAL)
+            except queue.Empty:
+                continue
+            with self.lock:
+                events = self.jobs.get(job)
+            if events is not None:
+                events.put(event)
+
+    def submit(self, values: dict):
+        # runs a job, yields its events until the summary or an error
+        job = next(self.ids)
+        events = queue.Queue()
+        with self.lock:
+            self.jobs[job] = events
+        try:
+            self.tasks.put((job, values))
+            yield {'job': job, 'event': 'queued'}
+            while True:
+                event = events.get()
+                yield {'job': job, **event}
+                if event['event'] in ('summary', 'error'):
+                    break
+        finally:
+            with self.lock:
+                del self.jobs[job]
+
+    def status(self) -> dict:
+        with self.lock:
+            jobs = len(self.jobs)
+        return {'processes': self.processes, 'jobs': jobs}
+
+    def serve(self) -> None:
+        # blocks until close() is called from another thread or the process is interrupted
+        if self.socket:
+            if Path(self.socket).exists():
+                os.unlink(self.socket)
+            self.server = UnixServer(self.socket, ServiceHandler)
+            logger.info(f"Serving on unix socket {self.socket} with {self.processes} workers")
+        else:
+            self.server = TCPServer((self.HOST, self.port), ServiceHandler)
+            logger.info(f"Serving on http://{self.HOST}:{self.port} with {self.processes} workers")
+        self.server.service = self
+        self.server.serve_forever()
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if self.socket and Path(self.socket).exists():
+                os.unlink(self.socket)
+            self.server = None
+        self.stop_workers()
+        self.stopped.set()
+        self.dispatcher.join()
+
+    def stop_workers(self) -> None:
+        # idle workers stop at their sentinel, busy and stuck ones are killed after the timeout
+        for _ in self.workers:
+            self.tasks.put(None)
+        # the sentinels may never be read, they must not keep the process alive
+        self.tasks.cancel_join_thread()
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for process in self.workers:
+            process.join(max(0, deadline - time.monotonic()))
+        for process in self.workers:
+            if process.is_alive():
+                logger.warning(f"Worker {process.pid} did not stop -> killed")
+                process.kill()
+                process.join()
+        self.workers = []
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    # the response of a job ends when the connection is closed
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args) -> None:
+        # unix sockets have no client address
+        logger.debug(f"{self.command} {self.path}: {format % args}")
+
+    def send_json(self, code: int, data: dict) -> None:
+        body = json.dumps(data).encode() + b"\n"
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path != "/status":
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        self.send_json(200, self.server.service.status())
+
+    def do_POST(self) -> None:
+        if self.path != "/jobs":
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            values = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(values, dict) or not all(isinstance(options, dict) for options in values.values()):
+                raise ValueError("expected an object of sections with options")
+        except ValueError as e:
+            self.send_json(400, {'error': f"Invalid job: {e}"})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        events = self.server.service.submit(values)
+        try:
+            for event in events:
+                self.wfile.write(json.dumps(event).encode() + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("Client disconnected -> job runs to its end without streaming")
+        finally:
+            events.close()
+
+
+class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class ServiceWorker:
+    """
+    Runs the jobs of the service inside one worker process.
+
+    The modules are imported and a small simulation is run once when the
+    process starts, so the jobs only pay for their own simulation.
+    """
+
+    # grid size of the simulation warming up the worker
+    WARMUP_SIZE = 8
+
+    def __init__(self, config: Configuration, events):
+        self.config = config
+        self.events = events
+        self.warm()
+
+    def warm(self) -> None:
+        values = self.values({'simulation': {'width': self.WARMUP_SIZE, 'height': self.WARMUP_SIZE}, 'preset': {'source': 'random'}})
+        sim = Simulation(self.configure(values))
+        sim.step()
+        sim.close()
+
+    def values(self, job: dict) -> dict:
+        # sections of the service configuration with the options of the job
+        # raw values, they are interpolated again when the configuration is read
+        values = {section: dict(self.config.config.items(section, raw=True)) for section in self.config.config.sections()}
+        for section, options in job.items():
+            values.setdefault(section, {}).update(options)
+        return values
+
+    def configure(self, values: dict) -> Configuration:
+        config = Configuration.from_dict(values)
+        # jobs are headless and single process like the sweep points
+        config.visualizers = []
+        if config.members > 0:
+            logger.warning("Jobs can not run ensembles -> single simulation")
+            config.members = 0
+        if config.engine == "parallel":
+            logger.warning("Jobs can not use the ParallelEngine -> fallback to FusedEngine")
+            config.engine = "fused"
+        return config
+
+    def send(self, job: int, event: dict) -> None:
+        self.events.put((job, event))
+
+    def run(self, job: int, values: dict) -> None:
+        start = time.perf_counter()
+        config = self.configure(self.values(values))
+        interval = max(1, config.getint('service', 'progress', fallback=SimulationService.DEFAULT_CONFIG['progress']))
+        # a file preset sets the grid size
+        sim = Simulation(config)
+        self.send(job, {'event': 'started', 'pid': os.getpid(), 'steps': config.steps, 'width': config.width, 'height': config.height})
+        counts = [sim.state.counts().copy()]
+        try:
+            for step, state in sim.iter_steps():
+                counts.append(state.counts().copy())
+                if step % interval == 0:
+                    self.send(job, {'event': 'progress', 'step': step, 'counts': dict(zip(STATE_NAMES, map(int, counts[-1])))})
+        finally:
+            sim.close()
+
+        summary = dict(zip(Sweep.METRICS, SweepWorker.summarize(np.array(counts), sim.state)))
+        summary['steps'] = sim.step_count
+        summary['converged'] = sim.monitor.reason if sim.monitor is not None else None
+        summary['seconds'] = time.perf_counter() - start
+        self.send(job, {'event': 'summary', **summary})
+
+
+# worker of the current process, created by init_worker
+worker: ServiceWorker = None
+
+
+def init_worker(config: Configuration, events) -> None:
+    global worker
+    # Ctrl+C and SIGTERM often reach the whole process group, only the service stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    worker = ServiceWorker(config, events)
+
+
+def work(config: Configuration, tasks, events) -> None:
+    # runs the jobs of the task queue until the sentinel None
+    init_worker(config, events)
+    for task in iter(tasks.get, None):
+        run_job(task)
+
+
+def run_job(task: tuple) -> None:
+    job, values = task
+    try:
+        worker.run(job, values)
+    except Exception as e:
+        logger.exception(f"Job {job} failed")
+        worker.send(job, {'event': 'error', 'message': str(e)})
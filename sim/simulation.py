@@ -1,43 +1,178 @@
+import copy
 import logging
 from config import Configuration
+from pathlib import Path
 from visual.visualizer import VisualizerContainer
 
+from .checkpoint import Checkpoint
+from .convergence import ConvergenceMonitor
+from .engine import EngineGenerator
 from .preset import PresetGenerator
-from .neighborhood import NeighborhoodGenerator
+from .profiler import Profiler
+from .neighborhood import Neighborhood, NeighborhoodGenerator, NeighborhoodWorkspace
 from .rule import RuleGenerator
+from .state import State
 
 
 class Simulation:
-    def __init__(self, config: Configuration):
+    """
+    A single simulation, either run() with the visualizers and checkpoints
+    of the configuration, or driven step by step with step() and
+    iter_steps(). The stepping methods only hand out read-only views of
+    the state and write nothing, so a configuration given as a dict needs
+    no config file or output directory.
+    """
+
+    def __init__(self, config: Configuration | dict, profiler: Profiler = None):
         self.logger = logging.getLogger("Simulation")
+        if isinstance(config, dict):
+            config = Configuration.from_dict(config)
         self.config = config
 
         self.preset = PresetGenerator.get(self.config)
         self.state = self.preset.generate()
         self.logger.debug(self.state)
 
-        self.neighborhood = NeighborhoodGenerator.get(self.config)
-
         self.rules = RuleGenerator.get(self.config)
 
+        # only calculate the neighborhood fields read by the rules
+        fields = RuleGenerator.neighborhood_fields(self.rules)
+        self.logger.debug(f"Neighborhood fields used: {sorted(fields)}")
+        self.logger.debug(f"Neighborhood fields skipped: {sorted(Neighborhood.FIELDS - fields)}")
+
+        self.workspace = NeighborhoodWorkspace(self.config, fields)
+        self.logger.debug(f"Neighborhood workspace holds {self.workspace.nbytes} bytes")
+        self.neighborhood = NeighborhoodGenerator.get(self.config, self.workspace)
+        self.neighborhood.arrange(self.state)
+
+        self.engine = EngineGenerator.get(self.config, self.neighborhood, self.rules)
+
         self.visualizers = VisualizerContainer(self.config)
 
+        self.checkpoint = Checkpoint(Path(self.config.output_dir) / self.config.checkpoint_name)
 
-    def run(self, steps: int = None):
+        # ends the run early once the state can not change anymore, if enabled
+        self.monitor = None
+        if ConvergenceMonitor.enabled(self.config):
+            self.monitor = ConvergenceMonitor(self.config, self.rules)
+
+        # steps simulated so far, running is False once the monitor ended the run and None before it started
+        self.step_count = 0
+        self.running = None
+
+        # phases are only timed if a profiler is given
+        self.profiler = profiler
+        if self.profiler is not None:
+            self.profiler.attach(self.engine, self.neighborhood, self.rules, self.visualizers)
+            self.profiler.instrument(self.checkpoint, 'save', 'checkpoint')
+
+    def run(self, steps: int = None, resume: bool = False):
         steps = steps if steps else self.config.steps 
+        interval = self.config.checkpoint_interval
+
+        start = 0
+        if resume:
+            # the frames up to the checkpoint have already been passed to the visualizers
+            start = self.checkpoint.load(self.state, self.rules, self.visualizers.checkpointed(), self.monitors())
+            self.logger.info(f"Resuming from step {start}")
+        else:
+            #pass intial frame to visualizer
+            self.visualizers.visualize(self.state, 0)
+            if self.profiler is not None:
+                self.profiler.end_step(0)
+
+        if not self.begin(start, resume):
+            steps = start
 
-        #pass intial frame to visualizer
-        self.visualizers.visualize(self.state)
+        try:
+            for step in range(start, steps):
+                self.advance()
+                
+                #pass frame to visualizer
+                self.visualizers.visualize(self.state, step + 1)
 
-        for step in range(steps):
-            #calculate neighborhood
-            nbs = self.neighborhood.calculate(self.state)
+                if interval > 0 and (step + 1) % interval == 0:
+                    # frames up to the checkpoint have to be written before it is saved
+                    self.visualizers.flush()
+                    self.checkpoint.save(step + 1, self.state, self.rules, self.visualizers.checkpointed(), self.monitors())
 
-            #apply rules
-            for rule in self.rules:
-                self.state = rule.calculate(self.state, nbs)
-            
-            #pass frame to visualizer
-            self.visualizers.visualize(self.state)
+                if self.profiler is not None:
+                    self.profiler.end_step(step + 1)
+
+                if not self.running:
+                    break
+        finally:
+            self.close()
+
+        if self.monitor is not None:
+            self.monitor.save(self.step_count)
 
         self.visualizers.finish()
+        if self.profiler is not None:
+            self.profiler.end_step('finish')
+        self.logger.debug(f"Derived field cache: {State.cache_info['hits']} hits, {State.cache_info['misses']} misses")
+
+    def begin(self, start: int = 0, resume: bool = False) -> bool:
+        # the monitor also sees the state the run starts from, False if it is converged already
+        self.step_count = start
+        if self.monitor is None:
+            self.running = True
+        elif resume:
+            # the restored monitor has seen the state of the checkpoint
+            self.running = not self.monitor.stopped()
+        else:
+            self.running = not self.monitor.update(self.state, start)
+        return self.running
+
+    def monitors(self) -> list:
+        # saved in checkpoints next to the rules and visualizers
+        return [self.monitor] if self.monitor is not None else []
+
+    def advance(self) -> None:
+        # calculate neighborhood and apply rules, unless a steady state is replayed
+        replay = self.monitor.replay() if self.monitor is not None else None
+        self.state = replay if replay is not None else self.engine.step(self.state)
+        self.step_count += 1
+        if self.monitor is not None and self.monitor.update(self.state, self.step_count):
+            self.running = False
+
+    def view(self) -> State:
+        """
+        Read-only views of the current state, no arrays are copied.
+        Engines working in place change the viewed arrays with the next
+        step, copy them to keep a state. The ParallelEngine frees its
+        shared memory on close(), so its state is copied instead.
+        """
+        # imported here, the parallel module is only needed for the ParallelEngine
+        from .parallel import ParallelEngine
+        if isinstance(self.engine, ParallelEngine):
+            return copy.deepcopy(self.state).readonly()
+        return self.state.readonly()
+
+    def iter_steps(self, steps: int = None):
+        """
+        Simulates up to `steps` steps (default config.steps) and yields
+        (step, view()) after each of them. Stops early once the monitor
+        ended the run. Consumers can stop at any time and continue with
+        another call, the engine stays ready until close().
+        """
+        steps = steps if steps is not None else self.config.steps
+        if self.running is None:
+            self.begin()
+        for _ in range(steps):
+            if not self.running:
+                return
+            self.advance()
+            if self.profiler is not None:
+                self.profiler.end_step(self.step_count)
+            yield self.step_count, self.view()
+
+    def step(self, n: int = 1) -> State:
+        # simulates n steps, returns the view of the last state
+        for _ in self.iter_steps(n):
+            pass
+        return self.view()
+
+    def close(self) -> None:
+        # ends the worker processes of the parallel engine
+        self.engine.close()
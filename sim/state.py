@@ -1,3 +1,5 @@
+import copy
+import logging
 import numpy as np
 
 class State:
@@ -9,12 +11,203 @@ class State:
     HOT = 2
     VEGETATION = 3
 
-    def __init__(self, heat, fuel, oxygen, cell_state):
+    # dtype policies for the attributes of a state
+    # 'count' is used for the sums and counts of the neighborhood
+    DTYPES = {
+        'default': {
+            'heat': np.float64,
+            'fuel': np.int64,
+            'oxygen': np.int64,
+            'cell_state': np.int64,
+            'time_since_burnt_out': np.int64,
+            'count': np.float64,
+        },
+        'compact': {
+            'heat': np.uint8,
+            'fuel': np.uint8,
+            'oxygen': np.uint8,
+            'cell_state': np.uint8,
+            'time_since_burnt_out': np.uint16,
+            'count': np.uint8,
+        },
+    }
+
+    # cell state of the ghost cells outside the grid, counted as none of the states
+    OUTSIDE = STATESCOUNT
+
+    # attributes the derived fields are calculated from
+    SOURCES = ('cell_state', 'heat', 'fuel', 'oxygen')
+    # attributes read by the neighborhoods, stored with a ghost cell border by pad()
+    PADDED = ('heat', 'fuel', 'oxygen', 'cell_state')
+    # hits and misses of the derived-field caches of all states
+    cache_info = {'hits': 0, 'misses': 0}
+
+    def __init__(self, heat, fuel, oxygen, cell_state, dtypes: dict = None):
+        # derived field -> (source attribute, value), valid fields are in _valid
+        self._derived = {}
+        self._valid = set()
+        # attribute -> array with a border of ghost cells, the attribute is a view onto its interior
+        self.padded = None
+        self.border = 0
+        if dtypes is not None:
+            heat = heat.astype(dtypes['heat'], copy=False)
+            fuel = fuel.astype(dtypes['fuel'], copy=False)
+            oxygen = oxygen.astype(dtypes['oxygen'], copy=False)
+            cell_state = cell_state.astype(dtypes['cell_state'], copy=False)
         self.heat = heat
         self.fuel = fuel
         self.oxygen = oxygen
         self.cell_state = cell_state
-        self.time_since_burnt_out = np.zeros_like(cell_state, dtype=int)
+        timer_dtype = dtypes['time_since_burnt_out'] if dtypes is not None else int
+        self.time_since_burnt_out = np.zeros_like(cell_state, dtype=timer_dtype)
+
+    @classmethod
+    def get_dtypes(cls, policy: str) -> dict:
+        dtypes = cls.DTYPES.get(policy)
+        if dtypes is None:
+            logging.getLogger("State").error(f"Invalid dtype policy {policy} -> fallback to default")
+            dtypes = cls.DTYPES['default']
+        return dtypes
+
+    def __setattr__(self, name, value):
+        padded = self.__dict__.get('padded')
+        if padded is not None and name in padded:
+            # new values of a padded attribute are copied into the interior of its storage
+            current = self.__dict__[name]
+            if value is not current:
+                np.copyto(current, value)
+                self.invalidate(name)
+            return
+        super().__setattr__(name, value)
+        # a new array invalidates its derived fields, their buffers can not be reused
+        if name in self.SOURCES:
+            self.invalidate(name, keep_buffers=False)
+
+    def __copy__(self) -> State:
+        # copies get their own cache and share the arrays without the ghost cell storage
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other._derived = {}
+        other._valid = set()
+        other.padded = None
+        other.border = 0
+        return other
+
+    def __deepcopy__(self, memo) -> State:
+        other = self.__class__.__new__(self.__class__)
+        memo[id(self)] = other
+        for name, value in self.__dict__.items():
+            object.__setattr__(other, name, copy.deepcopy(value, memo))
+        other._derived = {}
+        other._valid = set()
+        if other.padded is not None:
+            # the copied attributes have to be views onto the copied storage again
+            for name, padded in other.padded.items():
+                object.__setattr__(other, name, other.interior(padded))
+        return other
+
+    def interior(self, padded: np.ndarray) -> np.ndarray:
+        b = self.border
+        return padded[..., b:padded.shape[-2] - b, b:padded.shape[-1] - b]
+
+    def pad(self, border: int) -> None:
+        """
+        Store the attributes read by the neighborhoods with a border of ghost cells.
+        The border holds zeros and OUTSIDE cell states until a boundary refreshes it.
+        """
+        self.unpad()
+        padded = {}
+        for name in self.PADDED:
+            values = getattr(self, name)
+            shape = (*values.shape[:-2], values.shape[-2] + 2*border, values.shape[-1] + 2*border)
+            padded[name] = np.full(shape, self.OUTSIDE if name == 'cell_state' else 0, dtype=values.dtype)
+        self.border = border
+        for name, array in padded.items():
+            np.copyto(self.interior(array), getattr(self, name))
+            setattr(self, name, self.interior(array))
+        self.padded = padded
+
+    def unpad(self) -> None:
+        # back to plain contiguous arrays
+        if self.padded is None:
+            return
+        padded = self.padded
+        self.padded = None
+        self.border = 0
+        for name in padded:
+            setattr(self, name, np.ascontiguousarray(getattr(self, name)))
+
+    def ghost(self, name: str, border: int):
+        # padded storage of an attribute with the given border, None if there is none
+        if self.padded is None or self.border != border:
+            return None
+        return self.padded.get(name)
+
+    def readonly(self) -> State:
+        # copy sharing the arrays through read-only views, it sees in-place changes of this state
+        other = copy.copy(self)
+        for name in (*self.PADDED, 'time_since_burnt_out'):
+            view = getattr(self, name).view()
+            view.flags.writeable = False
+            setattr(other, name, view)
+        return other
+
+    def cached(self, key):
+        # value of a derived field, None if it has to be calculated
+        if key in self._valid:
+            State.cache_info['hits'] += 1
+            return self._derived[key][1]
+        State.cache_info['misses'] += 1
+        return None
+
+    def store(self, key, source: str, value):
+        self._derived[key] = (source, value)
+        self._valid.add(key)
+        return value
+
+    def invalidate(self, source: str = None, keep_buffers: bool = True) -> None:
+        """
+        Invalidate the derived fields of a source attribute, default all.
+        Has to be called after a source attribute is written in place.
+        """
+        for key, (src, value) in list(self._derived.items()):
+            if source is None or src == source:
+                self._valid.discard(key)
+                if not keep_buffers:
+                    del self._derived[key]
+
+    def mask(self, value: int, out: np.ndarray = None) -> np.ndarray:
+        """
+        Cached mask of the cells in the given state, must not be written to.
+        The mask is calculated into `out` or the buffer of an invalidated mask, if possible.
+        """
+        key = ('mask', value)
+        mask = self.cached(key)
+        if mask is None:
+            if out is None and key in self._derived:
+                out = self._derived[key][1]
+            mask = self.store(key, 'cell_state', np.equal(self.cell_state, value, out=out))
+        return mask
+
+    def counts(self) -> np.ndarray:
+        # cached number of cells in each state
+        counts = self.cached(('counts',))
+        if counts is None:
+            counts = self.store(('counts',), 'cell_state', np.bincount(self.cell_state.ravel(), minlength=self.STATESCOUNT))
+        return counts
+
+    def view(self, index) -> State:
+        """
+        State of views onto the cells selected by `index`, writes go through to this state.
+        """
+        view = copy.copy(self)
+        for name, value in list(vars(self).items()):
+            if isinstance(value, np.ndarray):
+                setattr(view, name, value[index])
+            elif isinstance(value, list):
+                setattr(view, name, [v[index] if v is not None else None for v in value])
+        view.index = index
+        return view
 
     def __str__(self):
         return (
@@ -22,4 +215,26 @@ class State:
             f"Oxygen map:\n {self.oxygen}\n"
             f"Fuel map:\n {self.fuel}\n"
             f"Heat map:\n {self.heat}"
-        )
\ No newline at end of file
+        )
+
+
+def saturating_sub(a, value, out=None):
+    """
+    Calculate max(a - value, 0) without wrapping around for unsigned dtypes.
+    """
+    res = np.maximum(a, value, out=out)
+    return np.subtract(res, value, out=res)
+
+
+def saturating_add(a, value, limit=None, out=None):
+    """
+    Calculate min(a + value, limit) without overflowing the dtype.
+    Without a limit the largest value of the dtype is used.
+    """
+    if limit is None:
+        limit = np.iinfo(a.dtype).max if np.issubdtype(a.dtype, np.integer) else np.inf
+    if isinstance(value, np.ndarray):
+        # values above the limit would wrap around in limit - value
+        value = np.minimum(value, limit)
+    res = np.minimum(a, limit - value, out=out)
+    return np.add(res, value, out=res)
@@ -0,0 +1,201 @@
+import copy
+import csv
+import itertools
+import logging
+import multiprocessing
+import numpy as np
+import os
+from config import Configuration
+from pathlib import Path
+
+from .engine import EngineGenerator
+from .neighborhood import NeighborhoodGenerator, NeighborhoodWorkspace
+from .preset import PresetGenerator
+from .rule import RuleGenerator
+from .state import State
+
+logger = logging.getLogger("Sweep")
+
+
+class Sweep:
+    """
+    Run the simulation for every point of a parameter grid.
+
+    The grid is the cartesian product of the values in [sweep_grid].
+    Every point runs headless in a bounded pool of worker processes.
+    Each run contributes one row of summary metrics to a CSV table.
+    """
+
+    # parameters that can be swept and their types
+    PARAMETERS = {
+        'seed': int,
+        'rule_approach': str,
+        'threshold_sum': int,
+        't_heat': int,
+        't_fuel': int,
+        't_oxygen': int,
+        'pb': float,
+        'po': float,
+        'regen_rate': int,
+    }
+
+    METRICS = (
+        'final_fire',
+        'final_incombustible',
+        'final_hot',
+        'final_vegetation',
+        'final_burned_area',
+        'peak_fire',
+        'peak_fire_step',
+        'extinction_step',
+        'final_mean_heat',
+    )
+
+    DEFAULT_CONFIG = {
+        'processes': 0,
+        'chunksize': 1,
+        'name': 'sweep.csv',
+    }
+
+    def __init__(self, config: Configuration):
+        self.config = config
+        self.grid = self.get_grid()
+        processes = config.getint('sweep', 'processes', fallback=self.DEFAULT_CONFIG['processes'])
+        self.processes = processes if processes > 0 else os.cpu_count()
+        self.chunksize = config.getint('sweep', 'chunksize', fallback=self.DEFAULT_CONFIG['chunksize'])
+
+    def get_grid(self) -> list:
+        names = []
+        values = []
+        if self.config.config.has_section('sweep_grid'):
+            for name, raw in self.config.config['sweep_grid'].items():
+                if name not in self.PARAMETERS:
+                    logger.error(f"Parameter {name} can not be swept -> ignored")
+                    continue
+                names.append(name)
+                values.append([self.PARAMETERS[name](value) for value in raw.split()])
+        return [dict(zip(names, point)) for point in itertools.product(*values)]
+
+    def get_output_path(self) -> Path:
+        output_dir = Path(self.config.output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+        return output_dir / self.config.get('sweep', 'name', fallback=self.DEFAULT_CONFIG['name'])
+
+    def run(self) -> None:
+        logger.info(f"Sweeping {len(self.grid)} points with {self.processes} processes")
+        rows = [None] * len(self.grid)
+        with multiprocessing.Pool(self.processes, initializer=init_worker, initargs=(self.config,)) as pool:
+            for i, metrics in pool.imap_unordered(run_point, enumerate(self.grid), chunksize=self.chunksize):
+                rows[i] = metrics
+                logger.debug(f"Finished point {i}: {self.grid[i]}")
+        self.save(rows)
+
+    def save(self, rows: list) -> None:
+        output_path = self.get_output_path()
+        names = list(self.grid[0].keys()) if self.grid else []
+        with open(output_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["run", *names, *self.METRICS])
+            for i, (point, metrics) in enumerate(zip(self.grid, rows)):
+                writer.writerow([i, *point.values(), *metrics])
+        logger.info(f"Saved sweep results to {output_path}")
+
+
+class SweepWorker:
+    """
+    Runs the points of a sweep inside one worker process.
+
+    Imports happen once per process, and presets, neighborhood
+    workspaces and kernel buffers are reused between the points.
+    """
+
+    def __init__(self, config: Configuration):
+        self.config = copy.deepcopy(config)
+        # runs are headless and single process
+        self.config.visualizers = []
+        self.config.members = 0
+        if self.config.engine == "parallel":
+            logger.warning("Sweep points can not use the ParallelEngine -> fallback to FusedEngine")
+            self.config.engine = "fused"
+        self.presets = {}
+        self.workspaces = {}
+        self.buffers = {}
+
+    def configure(self, point: dict) -> Configuration:
+        config = copy.deepcopy(self.config)
+        for name, value in point.items():
+            if name == 'regen_rate':
+                # read by the RuleGenerator from its own section
+                config.set('RegenerateFromBurntOutRule', 'regen_rate', value)
+            else:
+                setattr(config, name, value)
+        return config
+
+    def get_state(self, config: Configuration) -> State:
+        # presets only depend on the seed here, the simulation changes the state in place
+        if config.seed not in self.presets:
+            self.presets[config.seed] = PresetGenerator.get(config).generate()
+        state = copy.deepcopy(self.presets[config.seed])
+        # file presets set the grid size when created, so cached ones have to as well
+        config.width, config.height = state.cell_state.shape
+        return state
+
+    def get_workspace(self, config: Configuration, fields: set) -> NeighborhoodWorkspace:
+        key = frozenset(fields)
+        if key not in self.workspaces:
+            self.workspaces[key] = NeighborhoodWorkspace(config, fields)
+        return self.workspaces[key]
+
+    def run(self, point: dict) -> tuple:
+        config = self.configure(point)
+        state = self.get_state(config)
+        rules = RuleGenerator.get(config)
+        workspace = self.get_workspace(config, RuleGenerator.neighborhood_fields(rules))
+        neighborhood = NeighborhoodGenerator.get(config, workspace)
+        neighborhood.arrange(state)
+        engine = EngineGenerator.get(config, neighborhood, rules)
+        if hasattr(engine, 'kernel'):
+            # scratch buffers of the fused kernel are the same for every point
+            engine.kernel.buffers = self.buffers
+
+        counts = np.zeros((config.steps + 1, State.STATESCOUNT), dtype=np.int64)
+        counts[0] = np.bincount(state.cell_state.ravel(), minlength=State.STATESCOUNT)
+        try:
+            for step in range(config.steps):
+                state = engine.step(state)
+                counts[step + 1] = np.bincount(state.cell_state.ravel(), minlength=State.STATESCOUNT)
+        finally:
+            engine.close()
+
+        return self.summarize(counts, state)
+
+    @staticmethod
+    def summarize(counts: np.ndarray, state: State) -> tuple:
+        final = counts[-1]
+        fire = counts[:, State.FIRE]
+        extinct = np.nonzero(fire == 0)[0]
+        return (
+            int(final[State.FIRE]),
+            int(final[State.INCOMBUSTIBLE]),
+            int(final[State.HOT]),
+            int(final[State.VEGETATION]),
+            int(final[State.FIRE] + final[State.INCOMBUSTIBLE]),
+            int(fire.max()),
+            int(fire.argmax()),
+            int(extinct[0]) if len(extinct) else -1,
+            float(np.mean(state.heat)),
+        )
+
+
+# worker of the current process, created by the pool initializer
+worker: SweepWorker = None
+
+
+def init_worker(config: Configuration) -> None:
+    global worker
+    worker = SweepWorker(config)
+
+
+def run_point(task: tuple) -> tuple:
+    i, point = task
+    return i, worker.run(point)
@@ -0,0 +1,30 @@
+import argparse
+import logging
+from config import Configuration
+from sim.sweep import Sweep
+
+logger = logging.getLogger("sweep")
+
+
+def main(config_file: str):
+    config = Configuration(config_file)
+
+    sweep = Sweep(config)
+    if not sweep.grid:
+        print(f"Error: No parameters to sweep in [sweep_grid] of '{config_file}'.")
+        exit(1)
+
+    logger.debug("Starting sweep")
+    sweep.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", help="Path to the configuration file (default: sim.ini)", type=str, default="sim.ini")
+    parser.add_argument("-d", "--debug", help="Debug mode with the given log level", type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='INFO')
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.debug.upper(), logging.INFO)
+    logging.basicConfig(filename="sweep.log", level=log_level)
+
+    main(args.config)
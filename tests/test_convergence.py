@@ -0,0 +1,64 @@
+import tempfile
+import unittest
+import numpy as np
+
+from config import Configuration
+from sim.simulation import Simulation
+
+
+class ConvergenceResumeTest(unittest.TestCase):
+    """
+    Runs interrupted within the history of the convergence monitor and
+    resumed from their checkpoint end like the uninterrupted run.
+    """
+
+    ATTRIBUTES = ('heat', 'fuel', 'oxygen', 'cell_state', 'time_since_burnt_out')
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def simulate(self, steps: int, after: str, directory: str, resume: bool = False) -> Simulation:
+        config = Configuration('sim.ini', values={
+            'simulation': {'size': 24, 'rule_approach': 'general'},
+            'checkpoint': {'interval': 50},
+            'convergence': {'enabled': 'yes', 'after': after},
+            'output': {'visualizers': '', 'directory': directory},
+        })
+        sim = Simulation(config)
+        sim.run(steps, resume=resume)
+        return sim
+
+    def test_resumed_runs(self):
+        for after, steps in (('stop', 1000), ('forward', 600)):
+            with self.subTest(after=after), tempfile.TemporaryDirectory() as directory:
+                reference = self.simulate(steps, after, self.directory.name)
+                # the cycle is found after the checkpoint of step 250, from hashes before it
+                self.assertEqual(reference.monitor.reason, 'cycle')
+                self.assertLess(reference.monitor.step - reference.monitor.cycle_period, 250)
+                self.assertGreater(reference.monitor.step, 250)
+
+                self.simulate(250, after, directory)
+                resumed = self.simulate(steps, after, directory, resume=True)
+                self.assertEqual(resumed.step_count, reference.step_count)
+                for name in ('reason', 'step', 'cycle_period', 'replayed'):
+                    self.assertEqual(getattr(resumed.monitor, name), getattr(reference.monitor, name))
+                for attr in self.ATTRIBUTES:
+                    np.testing.assert_array_equal(getattr(resumed.state, attr), getattr(reference.state, attr))
+
+    def test_resumed_forwarding(self):
+        # checkpoints taken while the cycle is collected and replayed
+        reference = self.simulate(800, 'forward', self.directory.name)
+        for interrupt in (400, 550):
+            with self.subTest(interrupt=interrupt), tempfile.TemporaryDirectory() as directory:
+                self.simulate(interrupt, 'forward', directory)
+                resumed = self.simulate(800, 'forward', directory, resume=True)
+                self.assertEqual(resumed.monitor.replayed, reference.monitor.replayed)
+                for attr in self.ATTRIBUTES:
+                    np.testing.assert_array_equal(getattr(resumed.state, attr), getattr(reference.state, attr))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+import numpy as np
+from pathlib import Path
+from PIL import Image
+
+from sim.simulation import Simulation
+from sim.state import State
+
+
+class FilePresetImageTest(unittest.TestCase):
+    """
+    Image presets stepped with compact dtypes, where the state keeps the
+    loaded arrays and the fused and tiled engines change them in place.
+    """
+
+    RULES = 'DecreaseWhenFireRule IncreaseHotForNeighborRule IncreaseHeatExactlyOneFireRule IncreaseHeatMoreThanOneFireRule IncreaseOxygenIfNeighborsHigherRule VegetationToHotRule CellOnFireRule DecreaseHeatInIncombustibleRule'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(1)
+        self.cell_state = rng.choice([State.VEGETATION, State.FIRE], size=(24, 17), p=[0.9, 0.1]).astype(np.uint8)
+        self.images = {}
+        for mode in ('L', 'P'):
+            img = Image.fromarray(self.cell_state, mode)
+            if mode == 'P':
+                img.putpalette([0x23, 0x00, 0x07, 0x60, 0x6C, 0x38, 0xD2, 0x82, 0x31, 0xC1, 0x1D, 0x1D])
+            path = Path(self.directory.name) / f"preset-{mode}.png"
+            img.save(path)
+            self.images[mode] = path
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def simulate(self, path: Path, **simulation) -> State:
+        values = {
+            'simulation': {'steps': 10, 'dtype': 'compact', 'rules': self.RULES, **simulation},
+            'preset': {'source': 'file', 'file': str(path)},
+            'output': {'visualizers': '', 'directory': self.directory.name},
+        }
+        sim = Simulation(values)
+        try:
+            sim.step(10)
+        finally:
+            sim.close()
+        return sim.state
+
+    def test_image_is_loaded(self):
+        for mode, path in self.images.items():
+            with self.subTest(mode=mode):
+                sim = Simulation({'simulation': {'dtype': 'compact'}, 'preset': {'source': 'file', 'file': str(path)}, 'output': {'visualizers': ''}})
+                self.assertEqual((sim.config.width, sim.config.height), self.cell_state.shape)
+                np.testing.assert_array_equal(sim.state.cell_state, self.cell_state)
+
+    def test_in_place_engines(self):
+        for mode, path in self.images.items():
+            reference = self.simulate(path)
+            for engine in ({'engine': 'fused'}, {'engine': 'sequential', 'tile_size': 8}, {'engine': 'fused', 'tile_size': 8}):
+                with self.subTest(mode=mode, **engine):
+                    state = self.simulate(path, **engine)
+                    for attr in ('heat', 'fuel', 'oxygen', 'cell_state'):
+                        np.testing.assert_array_equal(getattr(state, attr), getattr(reference, attr))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import tempfile
+import unittest
+import numpy as np
+from pathlib import Path
+
+from config import Configuration
+from sim.state import State
+from sim.sweep import SweepWorker
+
+
+class SweepFilePresetTest(unittest.TestCase):
+    """
+    Sweeps of a file preset, whose grid size differs from the configured
+    one. Points with a seed seen before reuse the cached preset.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(1)
+        cell_state = rng.choice([State.VEGETATION, State.FIRE], size=(24, 17), p=[0.9, 0.1])
+        self.path = Path(self.directory.name) / "preset.npy"
+        np.save(self.path, cell_state)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def configuration(self) -> Configuration:
+        return Configuration('sim.ini', values={
+            'simulation': {'size': 50, 'steps': 20, 'engine': 'fused'},
+            'preset': {'source': 'file', 'file': str(self.path)},
+            'output': {'visualizers': '', 'directory': self.directory.name},
+        })
+
+    def test_repeated_seeds(self):
+        points = [{'seed': 1, 'pb': 0.05}, {'seed': 2, 'pb': 0.05}, {'seed': 1, 'pb': 0.1}, {'seed': 2, 'pb': 0.1}]
+        worker = SweepWorker(self.configuration())
+        for point in points:
+            with self.subTest(**point):
+                metrics = worker.run(point)
+                # the final state counts cover the grid of the file
+                self.assertEqual(sum(metrics[:State.STATESCOUNT]), 24 * 17)
+                # a fresh worker has no cached preset
+                self.assertEqual(metrics, SweepWorker(self.configuration()).run(point))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,12 @@ from pathlib import Path
 from PIL import Image
 
 
+def scale(pixels: np.ndarray, scaling: int) -> np.ndarray:
+    # every pixel becomes a scaling x scaling square
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    return np.repeat(np.repeat(pixels, scaling, axis=0), scaling, axis=1)
+
+
 class BackendGenerator:
     @classmethod
     def get(cls, ext: str) -> Backend:
@@ -36,7 +42,8 @@ class Backend(ABC):
 
 class ImageBackend(Backend):
     @abstractmethod
-    def write(self, outfile, width: int, height: int, pixels, scaling: int, *args, **kwargs):
+    def write(self, outfile, pixels: np.ndarray, scaling: int, *args, **kwargs):
+        # pixels: (H, W, 3) uint8 array, each pixel is scaled up to a scaling x scaling square
         pass
 
 
@@ -47,28 +54,21 @@ class PlotBackend(Backend):
 
 
 class PPM(ImageBackend):
-    def write(self, outfile, width: int, height: int, pixels, scaling: int = 60):
-        w = width * scaling
-        h = height * scaling
-        with open(outfile, "w") as f:
-            f.write(f'P3\n{w} {h}\n255\n')
-            output = ""
-            for y in range(0, height):
-                line = ""
-                for x in range(0, width):
-                    ind = y * width + x
-                    px_str = [str(x) for x in pixels[ind]]
-                    line += (" ".join(px_str) + "\n") * scaling
-                output += line*scaling
-            f.write(output)
+    def write(self, outfile, pixels: np.ndarray, scaling: int = 60):
+        pixels = scale(pixels, scaling)
+        h, w = pixels.shape[:2]
+        # binary PPM, the pixels are written as one buffer
+        with open(outfile, "wb") as f:
+            f.write(f'P6\n{w} {h}\n255\n'.encode())
+            f.write(np.ascontiguousarray(pixels).data)
 
 
 class PNG(ImageBackend):
-    def write(self, outfile, width, height, pixels, scaling, *args, **kwargs):
-        pixels = np.array(pixels, dtype=np.uint8)
-        pixels = np.reshape(pixels, (width, height, 3))
+    def write(self, outfile, pixels: np.ndarray, scaling: int, *args, **kwargs):
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        h, w = pixels.shape[:2]
         img = Image.fromarray(pixels, "RGB")
-        img = img.resize((width * scaling, height * scaling), resample=Image.Resampling.NEAREST)
+        img = img.resize((w * scaling, h * scaling), resample=Image.Resampling.NEAREST)
         img.save(outfile)
 
 
@@ -81,4 +81,6 @@ class PLT(PlotBackend):
         plt.xlabel(x_label, **labelprops)
         plt.ylabel(y_label, **labelprops)
         plt.grid(True)
-        plt.savefig(outfile, format=format, dpi=dpi)
\ No newline at end of file
+        plt.savefig(outfile, format=format, dpi=dpi)
+        # pyplot keeps every figure open until it is closed
+        plt.close()
\ No newline at end of file
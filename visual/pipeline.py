@@ -0,0 +1,77 @@
+import copy
+import logging
+import queue
+import threading
+from sim.state import State
+
+
+class FramePipeline:
+    """
+    Renders frames in background threads while the simulation continues.
+
+    Frames are queued as (render function, arguments) with a snapshot of
+    the state. The queue is bounded, so a simulation that runs ahead of
+    the rendering blocks until a frame has been written. The first error
+    of a render thread is raised again by the next call to submit(),
+    flush() or close(), so the run fails like a synchronous render would.
+    """
+
+    ATTRIBUTES = ('heat', 'fuel', 'oxygen', 'cell_state', 'time_since_burnt_out')
+
+    def __init__(self, workers: int, size: int):
+        self.logger = logging.getLogger("FramePipeline")
+        self.queue = queue.Queue(maxsize=max(size, 1))
+        self.error = None
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+        self.logger.debug(f"Started {workers} render threads with a queue of {self.queue.maxsize} frames")
+
+    @classmethod
+    def snapshot(cls, state: State) -> State:
+        # copy of the arrays, the engines change the state in place
+        snapshot = copy.copy(state)
+        for attr in cls.ATTRIBUTES:
+            setattr(snapshot, attr, getattr(state, attr).copy())
+        return snapshot
+
+    def submit(self, func, *args) -> None:
+        self.raise_error()
+        self.queue.put((func, args))
+
+    def work(self) -> None:
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    break
+                func, args = task
+                func(*args)
+            except Exception as e:
+                self.logger.exception("Rendering a frame failed")
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self) -> None:
+        # wait until all queued frames are written
+        self.queue.join()
+        self.raise_error()
+
+    def close(self) -> None:
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.raise_error()
+
+    def raise_error(self) -> None:
+        # raised once, in the thread running the simulation
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
@@ -0,0 +1,124 @@
+import logging
+import numpy as np
+from config import Configuration
+from pathlib import Path
+from sim.state import State
+
+
+class Statistics:
+    """
+    Per-step aggregates of the state, shared by the visualizers.
+
+    Every attribute is reduced in a single np.bincount pass, the state
+    counts, means, minima, maxima and histograms are derived from it.
+    The results are stored in preallocated arrays with one row per
+    recorded step. Subscribers are called with the row after each record.
+    """
+
+    ATTRIBUTES = ('cell_state', 'heat', 'fuel', 'oxygen')
+
+    DEFAULT_CONFIG = {
+        'bins': 16,
+    }
+
+    def __init__(self, config: Configuration):
+        self.logger = logging.getLogger("Statistics")
+        self.bins = max(State.STATESCOUNT, config.getint('statistics', 'bins', fallback=self.DEFAULT_CONFIG['bins']))
+        self.rows = 0
+        self.subscribers = []
+        self.allocate(config.steps + 1)
+
+    def allocate(self, capacity: int) -> None:
+        self.step = np.zeros(capacity, dtype=np.int64)
+        self.mean = {attr: np.zeros(capacity) for attr in self.ATTRIBUTES}
+        self.min = {attr: np.zeros(capacity, dtype=np.int64) for attr in self.ATTRIBUTES}
+        self.max = {attr: np.zeros(capacity, dtype=np.int64) for attr in self.ATTRIBUTES}
+        self.hist = {attr: np.zeros((capacity, self.bins), dtype=np.int64) for attr in self.ATTRIBUTES}
+
+    def grow(self) -> None:
+        # runs longer than the configured steps, e.g. resumed ones
+        old = self.arrays()
+        self.allocate(2 * len(self.step))
+        self.restore(old)
+
+    @property
+    def counts(self) -> np.ndarray:
+        # number of cells in each state per row
+        return self.hist['cell_state'][:, :State.STATESCOUNT]
+
+    def subscribe(self, callback) -> None:
+        # callback(statistics, row) is called after every recorded step
+        self.subscribers.append(callback)
+
+    def record(self, state: State, step: int) -> int:
+        if self.rows == len(self.step):
+            self.grow()
+        row = self.rows
+        self.step[row] = step
+        for attr in self.ATTRIBUTES:
+            values = getattr(state, attr)
+            if attr == 'cell_state':
+                # shared with the other users of the state
+                hist = state.counts()
+            else:
+                if values.dtype.kind == 'f':
+                    values = values.astype(np.intp)
+                hist = np.bincount(values.ravel(), minlength=State.STATESCOUNT)
+            nonzero = np.flatnonzero(hist)
+            self.mean[attr][row] = (hist @ np.arange(len(hist))) / values.size
+            self.min[attr][row] = nonzero[0]
+            self.max[attr][row] = nonzero[-1]
+            # values beyond the last bin are counted in it
+            n = min(len(hist), self.bins)
+            self.hist[attr][row, :n] = hist[:n]
+            self.hist[attr][row, n:] = 0
+            self.hist[attr][row, -1] += hist[self.bins:].sum()
+        self.rows += 1
+        for callback in self.subscribers:
+            callback(self, row)
+        return row
+
+    def arrays(self, rows=None) -> dict:
+        # flat dict of the recorded rows, default all
+        rows = rows if rows is not None else slice(0, self.rows)
+        data = {'step': self.step[rows]}
+        for attr in self.ATTRIBUTES:
+            data[f'mean_{attr}'] = self.mean[attr][rows]
+            data[f'min_{attr}'] = self.min[attr][rows]
+            data[f'max_{attr}'] = self.max[attr][rows]
+            data[f'hist_{attr}'] = self.hist[attr][rows]
+        return data
+
+    def save(self, path: Path, rows=None) -> None:
+        # .npz with all arrays, otherwise a CSV table without the histograms
+        path = Path(path)
+        data = self.arrays(rows)
+        if path.suffix == ".npz":
+            np.savez_compressed(path, **data)
+        else:
+            counts = data['hist_cell_state'][:, :State.STATESCOUNT]
+            columns = [data['step'], *counts.T]
+            header = ["step", "fire", "incombustible", "hot", "vegetation"]
+            fmt = ["%d"] * len(header)
+            for attr in self.ATTRIBUTES:
+                for stat in ('mean', 'min', 'max'):
+                    columns.append(data[f'{stat}_{attr}'])
+                    header.append(f'{stat}_{attr}')
+                    fmt.append("%.9g" if stat == 'mean' else "%d")
+            np.savetxt(path, np.column_stack(columns), delimiter=",", header=",".join(header), comments="", fmt=fmt)
+        self.logger.info(f"Saved statistics to {path}")
+
+    def checkpoint(self) -> dict:
+        return self.arrays()
+
+    def restore(self, data: dict) -> None:
+        rows = len(data['step'])
+        while rows > len(self.step):
+            self.allocate(2 * len(self.step))
+        self.step[:rows] = data['step']
+        for attr in self.ATTRIBUTES:
+            self.mean[attr][:rows] = data[f'mean_{attr}']
+            self.min[attr][:rows] = data[f'min_{attr}']
+            self.max[attr][:rows] = data[f'max_{attr}']
+            self.hist[attr][:rows] = data[f'hist_{attr}']
+        self.rows = rows
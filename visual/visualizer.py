@@ -1,8 +1,10 @@
 import copy
 import inspect
+import json
 import logging
 import numpy as np
 import os
+import subprocess
 import sys
 from abc import ABC, abstractmethod
 from ffmpeg import FFmpeg
@@ -10,7 +12,9 @@ from pathlib import Path
 from config import Configuration
 from sim.state import State
 
-from .backend import BackendGenerator, ImageBackend, PlotBackend
+from .backend import BackendGenerator, ImageBackend, PlotBackend, scale
+from .pipeline import FramePipeline
+from .statistics import Statistics
 
 logger = logging.getLogger("Visualizer")
 
@@ -43,6 +47,18 @@ class VisualizerContainer:
                 continue
             self.visualizers.append(visualizer(config))
 
+        # statistics are calculated once per step for all visualizers using them
+        self.statistics = None
+        if any(vis.STATISTICS for vis in self.visualizers):
+            self.statistics = Statistics(config)
+            for vis in self.visualizers:
+                vis.statistics = self.statistics
+
+        # render frames in background threads, if enabled
+        self.pipeline = None
+        if config.render_workers > 0:
+            self.pipeline = FramePipeline(config.render_workers, config.render_queue)
+
     def get(self, name):
         visualizer = self.available_visualizers.get(name, None)
         if visualizer:
@@ -51,22 +67,65 @@ class VisualizerContainer:
         self.logger.error(f"Invalid visualizer: {name}")
         return None
 
-    def visualize(self, state: State) -> None:
-        for vis in self.visualizers:
-            vis.visualize(state)
+    def visualize(self, state: State, step: int) -> None:
+        due = [vis for vis in self.visualizers if vis.due(state, step)]
+        if self.statistics is not None and any(vis.STATISTICS for vis in due):
+            self.statistics.record(state, step)
+
+        snapshot = None
+        for vis in due:
+            if self.pipeline is not None and vis.ASYNC:
+                if snapshot is None:
+                    snapshot = self.pipeline.snapshot(state)
+                # the output path is fixed now, so frames are named by their frame_id
+                self.pipeline.submit(vis.render, snapshot, vis.get_output_path())
+                vis.advance(step)
+            else:
+                vis.visualize(state, step)
+
+    def flush(self) -> None:
+        if self.pipeline is not None:
+            self.pipeline.flush()
+
+    def checkpointed(self) -> list:
+        # everything saved in checkpoints, in a fixed order
+        if self.statistics is not None:
+            return [*self.visualizers, self.statistics]
+        return self.visualizers
 
     def finish(self) -> None:
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
         for vis in self.visualizers:
             vis.finish()
     
 
 class Visualizer(ABC):
+    # per-step lists collected by the visualizer, saved in checkpoints
+    SERIES = ()
+    # whether frames can be rendered in the background by render()
+    ASYNC = False
+    # whether the visualizer reads the shared Statistics
+    STATISTICS = False
+
     def __init__(self, config: Configuration):
         if not hasattr(self, 'DEFAULT_CONFIG'):
             raise NotImplementedError(f"{self.__class__.__name__} is missing DEFAULT_CONFIG")
         self.logger = logging.getLogger(self.__class__.__name__)
         self.config = config 
         self.frame_id = 0
+        # step of every frame
+        self.frame_steps = []
+
+        # schedule: every n-th step between start and stop, optionally only on changes
+        name = self.__class__.__name__
+        self.every = max(1, config.getint(name, 'every', fallback=self.DEFAULT_CONFIG.get('every', 1)))
+        self.start = config.getint(name, 'start', fallback=self.DEFAULT_CONFIG.get('start', 0))
+        self.stop = config.getint(name, 'stop', fallback=self.DEFAULT_CONFIG.get('stop', -1))
+        self.change = config.getint(name, 'change', fallback=self.DEFAULT_CONFIG.get('change', 0))
+        # number of FIRE and HOT cells at the last frame
+        self.population = -1
         
     def get_dir_name(self) -> str:
         dir = self.config.get(self.__class__.__name__, 'directory', fallback=self.DEFAULT_CONFIG.get('directory'))
@@ -95,10 +154,40 @@ class Visualizer(ABC):
             os.mkdir(dir)
         return dir / self.get_file_name()
 
-    def visualize(self, state: State):
+    def due(self, state: State, step: int) -> bool:
+        if step < self.start or (self.stop >= 0 and step > self.stop):
+            return False
+        if (step - self.start) % self.every != 0:
+            return False
+        if self.change > 0:
+            counts = state.counts()
+            population = int(counts[State.FIRE] + counts[State.HOT])
+            if self.population >= 0 and abs(population - self.population) <= self.change:
+                return False
+            self.population = population
+        return True
+
+    def visualize(self, state: State, step: int):
         self.frame(state)
+        self.advance(step)
+
+    def advance(self, step: int) -> None:
+        self.frame_steps.append(step)
         self.frame_id += 1
 
+    def checkpoint(self) -> dict:
+        data = {'frame_id': np.array(self.frame_id), 'frame_steps': np.array(self.frame_steps, dtype=np.int64), 'population': np.array(self.population)}
+        for name in self.SERIES:
+            data[name] = np.array(getattr(self, name))
+        return data
+
+    def restore(self, data: dict) -> None:
+        self.frame_id = int(data['frame_id'])
+        self.frame_steps = data['frame_steps'].tolist()
+        self.population = int(data['population'])
+        for name in self.SERIES:
+            setattr(self, name, data[name].tolist())
+
     @abstractmethod
     def frame(self, state: State):
         pass
@@ -109,6 +198,9 @@ class Visualizer(ABC):
 
 
 class ImageVisualizer(Visualizer):
+    # frames only depend on the state, so they can be rendered in the background
+    ASYNC = True
+
     def __init__(self, config):
         super().__init__(config)
 
@@ -123,6 +215,17 @@ class ImageVisualizer(Visualizer):
     def get_file_name(self) -> str:
         return self.get_pattern() % (self.frame_id)
 
+    def frame(self, state: State):
+        self.render(state, self.get_output_path())
+
+    def render(self, state: State, output_path: Path):
+        self.backend.write(output_path, self.pixels(state), scaling=self.get_scaling())
+
+    @abstractmethod
+    def pixels(self, state: State) -> np.ndarray:
+        # (H, W, 3) uint8 image of the state, one pixel per cell
+        pass
+
     def get_scaling(self) -> int:
         scaling = self.config.getint(self.__class__.__name__, 'scaling', fallback=self.DEFAULT_CONFIG.get('scaling'))
         if not scaling:
@@ -131,6 +234,19 @@ class ImageVisualizer(Visualizer):
 
 
 class VideoVisualizer(ImageVisualizer):
+    def __init__(self, config):
+        super().__init__(config)
+        name = self.__class__.__name__
+        self.images = self.config.getboolean(name, 'images', fallback=self.DEFAULT_CONFIG.get('images', True))
+        self.process = None
+        # set once ffmpeg stopped reading the stream, the frames are kept as images then
+        self.stream_failed = False
+        if self.get_video() and self.config.getboolean(name, 'stream', fallback=self.DEFAULT_CONFIG.get('stream', False)):
+            self.start_stream()
+        if not self.images and self.process is None:
+            self.logger.warning("Images can only be skipped when streaming the video -> images are written")
+            self.images = True
+
     def get_video(self) -> str:
         return self.config.get(self.__class__.__name__, 'video', fallback=self.DEFAULT_CONFIG.get('video'))
 
@@ -140,19 +256,88 @@ class VideoVisualizer(ImageVisualizer):
             raise NotImplementedError(f"{self.__class__.__name__}.DEFAULT_CONFIG is missing 'rate'.")
         return rate
 
+    def start_stream(self) -> None:
+        # ffmpeg encodes raw RGB frames from its stdin while the simulation runs
+        video_path = self.get_output_path().parent / self.get_video()
+        scaling = self.get_scaling()
+        size = f"{self.config.height * scaling}x{self.config.width * scaling}"
+        ffmpeg = (
+            FFmpeg()
+            .option("y")
+            .option("loglevel", "error")
+            .input("pipe:0", f="rawvideo", pix_fmt="rgb24", s=size, r=self.get_rate())
+            .output(video_path)
+        )
+        try:
+            self.process = subprocess.Popen(ffmpeg.arguments, stdin=subprocess.PIPE)
+        except OSError as e:
+            self.logger.error(f"FFmpeg could not be started ({e}) -> video is generated from the images")
+            return
+        # the frames have to reach ffmpeg in order
+        self.ASYNC = False
+        self.logger.info(f"Streaming video {video_path}")
+
+    def render(self, state: State, output_path: Path):
+        pixels = self.pixels(state)
+        if self.process is not None:
+            try:
+                self.process.stdin.write(scale(pixels, self.get_scaling()).data)
+            except OSError as e:
+                # the frame that could not be streamed is the first written as image
+                self.drop_stream(e)
+        if self.images:
+            self.backend.write(output_path, pixels, scaling=self.get_scaling())
+
+    def drop_stream(self, error: OSError) -> None:
+        # ffmpeg exited early, e.g. on invalid options or frame sizes
+        process = self.process
+        self.process = None
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        self.logger.error(f"FFmpeg stopped reading the stream ({error}), exit code {process.wait()} -> images are written from frame {self.frame_id} on")
+        self.images = True
+        self.stream_failed = True
+
+    def restore(self, data: dict) -> None:
+        super().restore(data)
+        if self.process is not None:
+            self.logger.warning("The streamed video only contains the frames after the checkpoint")
+
     def finish(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError as e:
+                self.logger.error(f"FFmpeg stopped reading the stream ({e})")
+            if self.process.wait() != 0:
+                self.logger.error(f"FFmpeg exited with code {self.process.returncode}")
+            self.process = None
+            return
         video_name = self.get_video()
-        if video_name:
+        if self.stream_failed:
+            self.logger.warning(f"No video {video_name} is generated after the failed stream, the frames are kept as images")
+        elif video_name:
             dir = Path(self.config.output_dir)
             dir = dir / self.get_dir_name()
             generate_video(dir, video_name, self.get_pattern(), self.get_rate())
 
 
 class PlotVisualizer(Visualizer):
+    # plots read their values from the shared statistics
+    STATISTICS = True
+    # rows of the statistics recorded for the frames
+    SERIES = ('rows',)
+
     def __init__(self, config):
         super().__init__(config)
         self.logger.debug(f"PlotVisualizer in da house!!!")
         self.backend = BackendGenerator.get(".plt")
+        self.rows = []
+
+    def frame(self, state):
+        self.rows.append(self.statistics.rows - 1)
 
     def get_plot_properties(self):
         props_name = self.config.get(self.__class__.__name__, 'plot_properties', fallback=None)
@@ -167,13 +352,12 @@ class PlotVisualizer(Visualizer):
         return {}
 
 
-COLOR_MAP = {
-    State.INCOMBUSTIBLE:    [0x23, 0x00, 0x07],
-    State.VEGETATION:       [0x60, 0x6C, 0x38], 
-    State.HOT:              [0xD2, 0x82, 0x31],
-    State.FIRE:             [0xC1, 0x1D, 0x1D], 
-}
-assert(len(COLOR_MAP) == State.STATESCOUNT)
+# RGB color of each state, indexed by the cell state
+COLOR_MAP = np.zeros((State.STATESCOUNT, 3), dtype=np.uint8)
+COLOR_MAP[State.INCOMBUSTIBLE] =    [0x23, 0x00, 0x07]
+COLOR_MAP[State.VEGETATION] =       [0x60, 0x6C, 0x38]
+COLOR_MAP[State.HOT] =              [0xD2, 0x82, 0x31]
+COLOR_MAP[State.FIRE] =             [0xC1, 0x1D, 0x1D]
 
 class CellStateVisualizer(VideoVisualizer):
     DEFAULT_CONFIG = {
@@ -184,13 +368,9 @@ class CellStateVisualizer(VideoVisualizer):
         'rate': 1,
     }
 
-    def frame(self, state: State):
-        width = self.config.width
-        height = self.config.height
-        scaling = self.get_scaling()
-        cell_state = state.cell_state.flatten()
-        cell_colors = [COLOR_MAP[x] for x in cell_state]
-        self.backend.write(self.get_output_path(), width, height, cell_colors, scaling=scaling)
+    def pixels(self, state: State) -> np.ndarray:
+        # one image row per row of the grid
+        return COLOR_MAP[state.cell_state]
 
 
 class FullVisualizer(VideoVisualizer):
@@ -261,6 +441,10 @@ class FullVisualizer(VideoVisualizer):
         0.80,  # capped influence
     ]
 
+    def __init__(self, config):
+        super().__init__(config)
+        self.lut = self.get_lut()
+
 
     def clamp(self, x):
         return max(0, min(255, int(x)))
@@ -318,22 +502,20 @@ class FullVisualizer(VideoVisualizer):
             max(0, min(255, int(g))), 
             max(0, min(255, int(b)))]
 
-    def frame(self, state: State):
-        width = self.config.width
-        height = self.config.height
-        scaling = self.get_scaling()
-        # flatten arrays and compute color per cell
-        heat_arr = state.heat.flatten()
-        fuel_arr = state.fuel.flatten()
-        oxy_arr = state.oxygen.flatten()
-        st_arr = state.cell_state.flatten()
-
-        cell_colors = [
-            self.cell_color(s, h, f, o)
-            for h, f, o, s in zip(heat_arr, fuel_arr, oxy_arr, st_arr)
-        ]
+    def get_lut(self) -> np.ndarray:
+        """
+        Color of every (state, heat, fuel, oxygen) combination, computed once with cell_color.
+        """
+        levels = len(self.FUEL_LUT)
+        lut = np.empty((State.STATESCOUNT, levels, levels, levels, 3), dtype=np.uint8)
+        for index in np.ndindex(lut.shape[:-1]):
+            lut[index] = self.cell_color(*index)
+        return lut
 
-        self.backend.write(self.get_output_path(), width, height, cell_colors, scaling=scaling)
+    def pixels(self, state: State) -> np.ndarray:
+        # look up the colors of all cells at once
+        heat = state.heat.astype(np.intp, copy=False)
+        return self.lut[state.cell_state, heat, state.fuel, state.oxygen]
 
 
 class HeatPlotVisualizer(PlotVisualizer):
@@ -342,17 +524,10 @@ class HeatPlotVisualizer(PlotVisualizer):
             'name': 'output.png',
     }
 
-    def __init__(self, config):
-        super().__init__(config)
-        self.avg_heat = []
-
-    def frame(self, state):
-        self.avg_heat.append(np.mean(state.heat))
-
     def finish(self):
         if isinstance(self.backend, PlotBackend):
-            x = [x for x in range(len(self.avg_heat))]
-            y = self.avg_heat
+            x = self.frame_steps
+            y = self.statistics.mean['heat'][self.rows]
             output_path = self.get_output_path()
             self.logger.debug(f"Plot output path: {output_path}")
             self.backend.write(output_path, x, y, x_label="Step", y_label="Avg. heat", labelprops=self.get_label_properties(), **self.get_plot_properties())
@@ -366,58 +541,166 @@ class AllAttributePlotVisualizer(PlotVisualizer):
             'pattern': 'output-%s.png',
     }
 
-    def __init__(self, config):
-        super().__init__(config)
-        self.num_fir = []
-        self.num_inc = []
-        self.num_hot = []
-        self.num_veg = []
-        self.avg_cell_state = []
-        self.avg_heat = []
-        self.avg_oxygen = []
-        self.avg_fuel = []
-
     def get_file_name(self):
         return ""
 
-    def frame(self, state):
-        self.num_fir.append((state.cell_state == State.FIRE).sum())
-        self.num_inc.append((state.cell_state == State.INCOMBUSTIBLE).sum())
-        self.num_hot.append((state.cell_state == State.HOT).sum())
-        self.num_veg.append((state.cell_state == State.VEGETATION).sum())
-
-        self.avg_cell_state.append(np.mean(state.cell_state))
-        self.avg_heat.append(np.mean(state.heat))
-        self.avg_oxygen.append(np.mean(state.oxygen))
-        self.avg_fuel.append(np.mean(state.fuel))
-
     def finish(self):
         if isinstance(self.backend, PlotBackend):
-            x = [x for x in range(len(self.avg_heat))]
+            x = self.frame_steps
+            stats = self.statistics
+            counts = stats.counts[self.rows]
             output_path = self.get_output_path()
             plot_props = self.get_plot_properties()
             label_props = self.get_label_properties()
             self.logger.debug(f"Plot output path: {output_path}")
-            self.backend.write(output_path / (self.get_pattern() % ("cell_state")), x, self.avg_cell_state, x_label="Step", y_label="Avg. cell state", labelprops=label_props, **plot_props)
-            self.backend.write(output_path / (self.get_pattern() % ("heat")), x, self.avg_heat, x_label="Step", y_label="Avg. heat", labelprops=label_props,**plot_props)
-            self.backend.write(output_path / (self.get_pattern() % ("oxygen")), x, self.avg_oxygen, x_label="Step", y_label="Avg. oxygen", labelprops=label_props, **plot_props)
-            self.backend.write(output_path / (self.get_pattern() % ("fuel")), x, self.avg_fuel, x_label="Step", y_label="Avg. fuel", labelprops=label_props, **plot_props)
+            self.backend.write(output_path / (self.get_pattern() % ("cell_state")), x, stats.mean['cell_state'][self.rows], x_label="Step", y_label="Avg. cell state", labelprops=label_props, **plot_props)
+            self.backend.write(output_path / (self.get_pattern() % ("heat")), x, stats.mean['heat'][self.rows], x_label="Step", y_label="Avg. heat", labelprops=label_props,**plot_props)
+            self.backend.write(output_path / (self.get_pattern() % ("oxygen")), x, stats.mean['oxygen'][self.rows], x_label="Step", y_label="Avg. oxygen", labelprops=label_props, **plot_props)
+            self.backend.write(output_path / (self.get_pattern() % ("fuel")), x, stats.mean['fuel'][self.rows], x_label="Step", y_label="Avg. fuel", labelprops=label_props, **plot_props)
 
             import matplotlib.pyplot as plt
             plt.figure()
-            line_inc, = plt.plot(x, self.num_inc, label="Incombustible")
-            line_hot, = plt.plot(x, self.num_hot, label="Hot")
-            line_veg, = plt.plot(x, self.num_veg, label="Vegetation")
-            line_fir, = plt.plot(x, self.num_fir, label="Fire")
+            line_inc, = plt.plot(x, counts[:, State.INCOMBUSTIBLE], label="Incombustible")
+            line_hot, = plt.plot(x, counts[:, State.HOT], label="Hot")
+            line_veg, = plt.plot(x, counts[:, State.VEGETATION], label="Vegetation")
+            line_fir, = plt.plot(x, counts[:, State.FIRE], label="Fire")
             plt.xlabel("Step", **label_props)
             plt.ylabel("# Cells in State", **label_props)
             plt.legend(handles=[line_fir, line_inc, line_hot, line_veg])
             plt.savefig(output_path / (self.get_pattern() % ("num_states")))
+            plt.close()
 
         else:
             logger.error(f"{self.backend.__class__.__name__} is not a child of PlotBackend.")
 
 
+class StatisticsVisualizer(Visualizer):
+    """
+    Exports the shared statistics of its frames as a CSV table or, if the name ends with .npz, as arrays.
+    """
+
+    DEFAULT_CONFIG = {
+        'directory': 'statistics/',
+        'name': 'statistics.csv',
+    }
+    STATISTICS = True
+    SERIES = ('rows',)
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.rows = []
+
+    def frame(self, state):
+        self.rows.append(self.statistics.rows - 1)
+
+    def finish(self):
+        self.statistics.save(self.get_output_path(), self.rows)
+
+
+class TrajectoryVisualizer(Visualizer):
+    """
+    Records the attributes of every step into memory-mapped .npy files.
+
+    The files are preallocated for all steps in the compact dtypes, so
+    recording a step is a single copy into the mapping. A JSON header
+    describes the recording, load() opens it again without copying.
+    """
+
+    DEFAULT_CONFIG = {
+        'directory': 'trajectory/',
+        'pattern': '%s.npy',
+        'name': 'meta.json',
+    }
+
+    ATTRIBUTES = ('cell_state', 'heat', 'fuel', 'oxygen')
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.frames = None
+
+    def open(self) -> None:
+        meta_path = self.get_output_path()
+        shape = (self.config.steps + 1, self.config.width, self.config.height)
+        dtypes = State.get_dtypes('compact')
+        self.frames = {}
+        for attr in self.ATTRIBUTES:
+            path = meta_path.parent / (self.get_pattern() % attr)
+            if self.frame_id > 0 and path.exists():
+                # resumed runs continue the existing recording
+                self.frames[attr] = self.reopen(path, shape)
+            else:
+                self.frames[attr] = np.lib.format.open_memmap(path, mode='w+', dtype=dtypes[attr], shape=shape)
+        self.logger.debug(f"Recording {shape} frames to {meta_path.parent}")
+        self.write_meta()
+
+    def reopen(self, path: Path, shape: tuple) -> np.ndarray:
+        frames = np.lib.format.open_memmap(path, mode='r+')
+        if frames.shape[1:] != shape[1:]:
+            raise ValueError(f"Recording {path} has frames of size {frames.shape[1:]}, the resumed run has {shape[1:]}")
+        if len(frames) >= shape[0]:
+            return frames
+        # the resumed run has more steps, the recorded frames are copied into a larger file
+        grown_path = path.with_name(path.name + ".tmp")
+        grown = np.lib.format.open_memmap(grown_path, mode='w+', dtype=frames.dtype, shape=shape)
+        grown[:self.frame_id] = frames[:self.frame_id]
+        grown.flush()
+        del frames
+        os.replace(grown_path, path)
+        self.logger.info(f"Grew recording {path} from {self.frame_id} recorded frames to {shape[0]} frames")
+        return grown
+
+    def write_meta(self) -> None:
+        meta = {
+            'width': self.config.width,
+            'height': self.config.height,
+            'steps': self.config.steps,
+            'seed': self.config.seed,
+            'frames': self.frame_id,
+            'frame_steps': self.frame_steps,
+            'attributes': {attr: self.get_pattern() % attr for attr in self.ATTRIBUTES},
+        }
+        with open(self.get_output_path(), "w") as f:
+            json.dump(meta, f, indent=4)
+
+    def flush(self) -> None:
+        if self.frames is None:
+            return
+        for frames in self.frames.values():
+            frames.flush()
+        self.write_meta()
+
+    def frame(self, state: State):
+        if self.frames is None:
+            self.open()
+        capacity = len(self.frames[self.ATTRIBUTES[0]])
+        if self.frame_id >= capacity:
+            self.logger.error(f"Frame {self.frame_id} exceeds the {capacity} frames of the recording -> skipped")
+            return
+        for attr, frames in self.frames.items():
+            np.copyto(frames[self.frame_id], getattr(state, attr), casting='unsafe')
+
+    def checkpoint(self) -> dict:
+        # the recording has to be on disk up to the checkpoint
+        self.flush()
+        return super().checkpoint()
+
+    def finish(self):
+        self.flush()
+        self.frames = None
+
+    @classmethod
+    def load(cls, meta_path) -> tuple:
+        """
+        Open a recording by the path of its header.
+        Returns the header and read-only arrays (step, width, height) of the recorded frames.
+        """
+        meta_path = Path(meta_path)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        frames = {attr: np.load(meta_path.parent / name, mmap_mode='r')[:meta['frames']] for attr, name in meta['attributes'].items()}
+        return meta, frames
+
+
 
 if __name__ == "__main__":
     conf = Configuration("sim.ini")